@@ -8,21 +8,89 @@ import numpy as np
 #from maketopo import get_topo, make_dtopo
 from scipy import stats
 import os, sys
+import json
+import fcntl
+import shutil
+import hashlib
+import tempfile
 from scipy.interpolate import interp1d
 
 
 class Adjoint:
     """
     This Class sets up and runs the linearized adjoint solver, thus setting up the AMR parameters that are needed for a more accurate and adaptive mesh refinement
+
+    The adjoint solution only depends on the fgmax points, the bathymetry and the adjoint setrun, not on the earthquake,
+    so it is stored in a cache keyed by a fingerprint of those files and reused by every chain and restart that shares the cache.
     """
-    def __init__(self):
+    def __init__(self, cache_dir=None):
+        """
+        :param cache_dir: String: directory holding cached adjoint solutions.
+            Defaults to $ADJOINT_CACHE, or adjoint_cache in the node-local $TMPFS (or the system temp directory)
+        """
+        if cache_dir is None:
+            cache_dir = os.environ.get('ADJOINT_CACHE',
+                                       os.path.join(os.environ.get('TMPFS', tempfile.gettempdir()), 'adjoint_cache'))
+        self.cache_dir = cache_dir
+
+    def input_files(self):
+        """
+        Lists the files the adjoint solution depends on
+        :return: list of file paths (relative to the run directory)
+        """
+        with open('./PreRun/InputData/model_bounds.txt') as json_file:
+            model_bounds = json.load(json_file)
+
+        files = ['./PreRun/InputData/fgmax_grid.txt',
+                 './PreRun/InputData/model_bounds.txt',
+                 './InputData/adjoint/setrun.py',
+                 './InputData/adjoint/make_adjoint_topo.py',
+                 './InputData/adjoint/Makefile',
+                 './InputData/etopo.tt3']
+        files += [os.path.join('./InputData/', fname) for fname in model_bounds['gauge_topo']]
+        return files
 
-        pass
+    def fingerprint(self):
+        """
+        Hashes the contents of the adjoint input files
+        :return: String: hex digest identifying the adjoint solution
+        """
+        sha = hashlib.sha256()
+        for fname in self.input_files():
+            sha.update(os.path.basename(fname).encode())
+            with open(fname, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    sha.update(chunk)
+        return sha.hexdigest()[:16]
 
     def run_geo_claw(self):
+        """
+        Makes the adjoint solution available, solving only if it is not in the cache yet.
+        Sets $ADJOINT_OUTDIR, which setrun.py uses as the adjoint output directory of the forward runs.
+        :return: String: path of the adjoint output directory
+        """
+        key = self.fingerprint()
+        outdir = os.path.abspath(os.path.join(self.cache_dir, key))
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # Chains sharing the cache wait here while one of them does the solve
+        with open(outdir + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.isdir(outdir):
+                print("Reusing cached adjoint solution", outdir)
+            else:
+                self.solve()
+                shutil.move('./InputData/adjoint/_output', outdir + '.tmp')
+                os.rename(outdir + '.tmp', outdir)
+                print("Cached adjoint solution", outdir)
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+        os.environ['ADJOINT_OUTDIR'] = outdir
+        return outdir
+
+    def solve(self):
         """
         Runs the adjoint Geoclaw
-        :param draws: parameters
         :return:
         """
         """
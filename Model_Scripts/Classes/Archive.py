@@ -0,0 +1,73 @@
+"""
+Archive of chain states shared by concurrently running chains.
+"""
+import os
+import fcntl
+from collections import deque
+import numpy as np
+
+
+class Archive:
+    """
+    File shared by the chains running at the same time (e.g., the tasks of a job on one node). Each chain appends
+    its current state after every iteration as a line "chain,value,...", and reads the states the other chains
+    appended since its last read. The differential evolution proposals (MCMC.de_draw) use the recent states:
+    the first warmup states of each chain are skipped and only the last window states of each chain are kept,
+    so the jumps have the scale of the chains' current spread rather than of their burn-in.
+    """
+    def __init__(self, path, chain, cols, warmup=100, window=500):
+        """
+        :param path: String: archive file, the same for all the chains
+        :param chain: String: name of this chain (without commas)
+        :param cols: list of the sample parameters to archive
+        :param warmup: Int: states skipped at the start of each chain
+        :param window: Int: states kept of each chain
+        """
+        self.path = path
+        self.chain = chain
+        self.cols = cols
+        self.warmup = warmup
+        self.window = window
+        self.offset = 0
+        # number of states read and recent states of each other chain
+        self.counts = {}
+        self.other_states = {}
+
+    def append(self, params):
+        """
+        Appends a state of this chain
+        :param params: pandas Series: sample parameters
+        """
+        line = ','.join([self.chain] + ['%.10g' % value for value in params[self.cols]]) + '\n'
+        with open(self.path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(line)
+            f.flush()
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+    def states(self):
+        """
+        Recent states of the other chains
+        :return: (n, len(cols)) array
+        """
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                f.seek(self.offset)
+                lines = f.readlines()
+                fcntl.flock(f, fcntl.LOCK_UN)
+            for line in lines:
+                if not line.endswith('\n'):
+                    break
+                self.offset += len(line)
+                values = line.split(',')
+                if values[0] == self.chain or len(values) != len(self.cols) + 1:
+                    continue
+                count = self.counts.get(values[0], 0)
+                self.counts[values[0]] = count + 1
+                if count >= self.warmup:
+                    if values[0] not in self.other_states:
+                        self.other_states[values[0]] = deque(maxlen=self.window)
+                    self.other_states[values[0]].append([float(v) for v in values[1:]])
+        states = [state for chain_states in self.other_states.values() for state in chain_states]
+        return np.array(states).reshape(-1, len(self.cols))
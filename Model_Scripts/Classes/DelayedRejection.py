@@ -0,0 +1,129 @@
+"""
+Delayed rejection adaptive Metropolis (DRAM) proposals.
+"""
+import numpy as np
+import pandas as pd
+
+
+class DelayedRejection:
+    """
+    Delayed rejection with adaptive Metropolis (Haario, Laine, Mira and Saksman, 2006). When the proposal of
+    an iteration is rejected, a new one is drawn from the current sample with a smaller step, up to a maximum
+    number of stages. Stage k proposes
+        y_k ~ N(x, scales[k]^2 C),
+    and is accepted with the delayed rejection probability of Tierney and Mira (1999), which keeps the
+    posterior invariant. The small steps of the later stages move along narrow ridges of the posterior
+    (e.g. the trade-off of Magnitude with DeltaLogL and DeltaLogW) where most first stage proposals fail.
+
+    C is the covariance of the mcmc class's random walk (proposal_covariance) until adapt_start iterations,
+    then 2.38^2/d times the covariance of the chain so far, regularized by eps times the initial covariance.
+
+    The number of proposals and acceptances of each stage are counted for the stage table (see save).
+    """
+    def __init__(self, mcmc, stages=2, shrink=0.2, adapt_start=200, eps=1.e-3):
+        """
+        :param mcmc: MCMC: provides sample_cols and proposal_covariance (Custom)
+        :param stages: Int: maximum number of proposals per iteration
+        :param shrink: float: step scale of each stage relative to the previous one
+        :param adapt_start: Int: iterations before the covariance is adapted
+        :param eps: float: regularization of the adapted covariance
+        """
+        if stages < 1:
+            raise ValueError("Delayed rejection needs at least one stage")
+        if not hasattr(mcmc, 'proposal_covariance'):
+            raise ValueError("Delayed rejection needs the covariance of the random walk, but "
+                             + type(mcmc).__name__ + " has no proposal_covariance")
+        self.cols = mcmc.sample_cols
+        self.stages = stages
+        self.scales = shrink ** np.arange(stages)
+        self.adapt_start = adapt_start
+        self.eps = eps
+
+        self.initial_cov = np.asarray(mcmc.proposal_covariance(), dtype=float)
+        self.set_covariance(self.initial_cov)
+
+        # running mean and covariance of the chain
+        self.n = 0
+        self.mean = np.zeros(len(self.cols))
+        self.scatter = np.zeros((len(self.cols), len(self.cols)))
+
+        self.proposed = np.zeros(stages, dtype=int)
+        self.accepted = np.zeros(stages, dtype=int)
+
+    def set_covariance(self, cov):
+        self.cov = cov
+        self.cov_inv = np.linalg.inv(cov)
+
+    def adapt(self, sample_params):
+        """
+        Adds the current sample to the running covariance of the chain, and uses it for the
+        proposals once the chain has adapt_start samples
+        :param sample_params: pandas Series: current sample parameters
+        """
+        x = sample_params[self.cols].to_numpy(dtype=float)
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.scatter += np.outer(delta, x - self.mean)
+        if self.n >= self.adapt_start:
+            d = len(self.cols)
+            self.set_covariance(2.38**2 / d * (self.scatter / (self.n - 1) + self.eps * self.initial_cov))
+
+    def draw(self, prev_draw, stage=0):
+        """
+        Proposal of a stage
+        :param prev_draw: pandas Series: current sample parameters
+        :param stage: Int: stage (0 for the first proposal)
+        :return: pandas Series: proposal
+        """
+        new_draw = prev_draw.copy()
+        step = np.random.multivariate_normal(np.zeros(len(self.cols)), self.scales[stage]**2 * self.cov)
+        new_draw[self.cols] = prev_draw[self.cols].to_numpy(dtype=float) + step
+        return new_draw
+
+    def log_q(self, x, y, stage):
+        """Log density of the proposal of a stage from x to y, up to the normalization of the stage"""
+        d = y[self.cols].to_numpy(dtype=float) - x[self.cols].to_numpy(dtype=float)
+        return -0.5 * d @ self.cov_inv @ d / self.scales[stage]**2
+
+    def acceptance_prob(self, log_post, points):
+        """
+        Delayed rejection acceptance probability of the last of the points, after the proposals
+        points[1:-1] from points[0] were rejected
+        :param log_post: list of the log posteriors of the points (-inf outside the support)
+        :param points: list of pandas Series: current sample, then the proposals of each stage
+        :return: float
+        """
+        if np.isneginf(log_post[-1]):
+            return 0.
+        if np.isneginf(log_post[0]):
+            return 1.
+        log_ratio = log_post[-1] - log_post[0]
+        rev_post, rev_points = log_post[::-1], points[::-1]
+        for j in range(1, len(points) - 1):
+            # the reversed path: stage j from the last proposal to points[-1-j]
+            rev_prob = self.acceptance_prob(rev_post[:j + 1], rev_points[:j + 1])
+            if rev_prob >= 1.:
+                return 0.
+            fwd_prob = self.acceptance_prob(log_post[:j + 1], points[:j + 1])
+            log_ratio += self.log_q(rev_points[0], rev_points[j], j - 1) - self.log_q(points[0], points[j], j - 1)
+            log_ratio += np.log1p(-rev_prob) - np.log1p(-fwd_prob)
+        return np.exp(min(0., log_ratio))
+
+    def record(self, stage, accepted):
+        """Counts a proposal of a stage"""
+        self.proposed[stage] += 1
+        self.accepted[stage] += accepted
+
+    def save(self, fname):
+        """
+        Writes the stage table: for each stage the proposals (forward model runs), acceptances, acceptance rate
+        and share of all the acceptances
+        :param fname: String: csv file
+        """
+        table = pd.DataFrame({'Stage': np.arange(1, self.stages + 1),
+                              'Proposals': self.proposed,
+                              'Accepted': self.accepted})
+        table['Acceptance Rate'] = table['Accepted'] / table['Proposals'].where(table['Proposals'] > 0)
+        table['Share of Acceptances'] = table['Accepted'] / max(self.accepted.sum(), 1)
+        table.to_csv(fname, index=False)
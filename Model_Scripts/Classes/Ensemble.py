@@ -0,0 +1,88 @@
+"""
+Affine invariant ensemble sampler with parallel walker evaluations.
+"""
+import numpy as np
+import pandas as pd
+
+from ForwardPool import ForwardPool
+
+
+class Ensemble:
+    """
+    Ensemble MCMC with the stretch move of Goodman and Weare (2010), see MCMC.stretch_move. The walkers are split
+    into two halves and each half is moved using the current positions of the other half, so the proposals of
+    a half are independent of each other and their GeoClaw runs go to the worker pool at the same time.
+    Being affine invariant, the moves adapt to the strong correlations between Magnitude, DeltaLogL, DeltaLogW
+    and DeltaDepth, which the diagonal random walk of Custom.draw does not.
+
+    The chain store (ModelOutput/<scenario>_ensemble_chain.csv) holds one trace per walker: a row per
+    iteration and walker with its parameters, prior logpdf, log likelihood and whether it moved.
+    """
+    def __init__(self, scenario, num_walkers=24, num_workers=1, a=2., prior_steps=50):
+        """
+        :param scenario: Scenario: provides the mcmc class (prior, prior_logpdf, stretch_move), iterations and the forward model
+        :param num_walkers: Int: ensemble size (even, at least twice the number of parameters)
+        :param num_workers: Int: number of GeoClaw runs at a time
+        :param a: float: stretch scale of the moves
+        :param prior_steps: Int: Metropolis steps targeting the prior of the initial walkers (see MCMC.prior_sample)
+        """
+        self.scenario = scenario
+        self.mcmc = scenario.mcmc
+        if num_walkers % 2 or num_walkers < 2 * len(self.mcmc.sample_cols):
+            raise ValueError("The ensemble needs an even number of at least {} walkers".format(2 * len(self.mcmc.sample_cols)))
+        self.num_walkers = num_walkers
+        self.iterations = scenario.iterations
+        self.a = a
+        self.prior_steps = prior_steps
+        self.save_path = scenario.samples.save_path + 'ensemble_'
+        self.forward_pool = ForwardPool(scenario, num_workers)
+
+    def save_iteration(self, iteration, walkers, prior, llh, moved):
+        """Appends the state of every walker to the chain store"""
+        chain = pd.DataFrame([params[self.mcmc.sample_cols].tolist() for params in walkers], columns=self.mcmc.sample_cols)
+        chain.insert(0, 'Walker', np.arange(self.num_walkers))
+        chain.insert(0, 'Iteration', iteration)
+        chain['Prior'] = prior
+        chain['LLH'] = llh
+        chain['Moved'] = moved
+        chain.to_csv(self.save_path + 'chain.csv', mode='a', header=(iteration == 0), index=False)
+
+    def run(self):
+        """
+        Runs the ensemble for the scenario's number of iterations
+        :return: list of the final walkers
+        """
+        walkers, prior = self.mcmc.prior_sample(self.num_walkers, self.prior_steps)
+        llh = self.forward_pool.log_likelihoods(walkers)
+        self.save_iteration(0, walkers, prior, llh, np.ones(self.num_walkers, dtype=bool))
+
+        half = self.num_walkers // 2
+        halves = [np.arange(half), np.arange(half, self.num_walkers)]
+        for iteration in range(1, self.iterations + 1):
+            moved = np.zeros(self.num_walkers, dtype=bool)
+            for k in range(2):
+                active, other = halves[k], halves[1 - k]
+                proposals, log_z = [], []
+                for i in active:
+                    proposal, log_correction = self.mcmc.stretch_move(walkers[i], walkers[np.random.choice(other)], self.a)
+                    proposals.append(proposal)
+                    log_z.append(log_correction)
+                proposal_prior = np.array([self.mcmc.prior_logpdf(params) for params in proposals])
+                valid = np.nonzero(np.isfinite(proposal_prior))[0]
+                proposal_llh = np.full(half, np.NINF)
+                proposal_llh[valid] = self.forward_pool.log_likelihoods([proposals[j] for j in valid])
+
+                for j in valid:
+                    i = active[j]
+                    log_ratio = log_z[j] + proposal_prior[j] + proposal_llh[j] - prior[i] - llh[i]
+                    if np.isneginf(llh[i]) and np.isfinite(proposal_llh[j]):
+                        log_ratio = np.inf
+                    if np.log(np.random.random()) < log_ratio:
+                        walkers[i], prior[i], llh[i] = proposals[j], proposal_prior[j], proposal_llh[j]
+                        moved[i] = True
+
+            print("Ensemble iteration {}: acceptance rate {:.3f}, mean LLH {:.4g}".format(iteration, moved.mean(), np.mean(llh[np.isfinite(llh)])))
+            self.save_iteration(iteration, walkers, prior, llh, moved)
+
+        self.forward_pool.close()
+        return walkers
@@ -0,0 +1,109 @@
+"""
+Pool of forward model workers for the population samplers (SMC, Ensemble).
+"""
+import os
+import multiprocessing
+import numpy as np
+
+from FeedForward import FeedForward
+
+# forward model of a pool worker, see init_worker
+_worker = {}
+
+# generated by FeedForward in each run directory, so not shared with the workers
+RUN_FILES = ['dtopo.tt3', 'region_times.json', 'fgmax_gauges.json', 'greens_gauges.json']
+
+
+def forward(feedForward, gauges, okada_params):
+    """
+    Runs GeoClaw in the current directory and computes the tsunami log likelihood
+    :return: log likelihood, arrival times, wave heights (-inf and None if the run timed out)
+    """
+    os.system('rm ./InputData/dtopo.tt3')
+    if not feedForward.run_geo_claw(okada_params):
+        return np.NINF, None, None
+    return feedForward.calculate_llh(gauges)
+
+
+def init_worker(dirs, feed_forward_args, gauges):
+    """Pool initializer: moves the worker to its own run directory"""
+    os.chdir(dirs.get())
+    _worker['feedForward'] = FeedForward(*feed_forward_args)
+    _worker['gauges'] = gauges
+
+
+def worker_forward(okada_params):
+    return forward(_worker['feedForward'], _worker['gauges'], okada_params)
+
+
+def make_worker_dir(path):
+    """
+    Sets up a run directory for a forward model worker inside the current run directory. GeoClaw writes
+    its data, dtopo and output files to fixed names, so each worker needs its own. The inputs are linked.
+    :param path: String: worker directory
+    :return: String: absolute path of the worker directory
+    """
+    os.makedirs(os.path.join(path, 'InputData'), exist_ok=True)
+    os.makedirs(os.path.join(path, 'ModelOutput'), exist_ok=True)
+    os.system('cp Makefile ' + path + '/')
+    for name in ['Classes', 'PreRun']:
+        if not os.path.lexists(os.path.join(path, name)):
+            os.symlink(os.path.abspath(name), os.path.join(path, name))
+    for fname in os.listdir('./InputData'):
+        dest = os.path.join(path, 'InputData', fname)
+        if fname not in RUN_FILES and not os.path.lexists(dest):
+            os.symlink(os.path.abspath(os.path.join('./InputData', fname)), dest)
+    return os.path.abspath(path)
+
+
+class ForwardPool:
+    """
+    Evaluates the log likelihoods of a population of samples, running their GeoClaw simulations at the same
+    time in a multiprocessing pool. Each worker has its own run directory under ./workers, set up on the first
+    call, and compiles GeoClaw on its first run. With one worker the runs are done in the run directory.
+    """
+    def __init__(self, scenario, num_workers=1):
+        """
+        :param scenario: Scenario: provides the mcmc class (map_to_okada), gauges, feedForward and shake likelihood
+        :param num_workers: Int: number of GeoClaw runs at a time
+        """
+        self.scenario = scenario
+        self.num_workers = num_workers
+        self.pool = None
+
+    def start(self):
+        """Starts the worker pool"""
+        dirs = multiprocessing.Manager().Queue()
+        for k in range(self.num_workers):
+            dirs.put(make_worker_dir(os.path.join('workers', str(k))))
+        ff = self.scenario.feedForward
+        feed_forward_args = (ff.region_times, ff.timeout_factor, ff.settle_window, ff.unit_sources is not None)
+        self.pool = multiprocessing.Pool(self.num_workers, init_worker,
+                                         (dirs, feed_forward_args, self.scenario.gauges))
+
+    def log_likelihoods(self, samples):
+        """
+        Log likelihoods of a list of samples (nan log likelihoods are returned as -inf)
+        :param samples: list of pandas Series of sample parameters
+        :return: (n,) array
+        """
+        okada = [self.scenario.mcmc.map_to_okada(params) for params in samples]
+        if self.num_workers <= 1:
+            results = [forward(self.scenario.feedForward, self.scenario.gauges, okada_params) for okada_params in okada]
+        else:
+            if self.pool is None:
+                self.start()
+            results = self.pool.map(worker_forward, okada, chunksize=1)
+
+        llh = np.array([result[0] for result in results], dtype=float)
+        llh[np.isnan(llh)] = np.NINF
+        if self.scenario.shake:
+            llh += np.array([self.scenario.shake_llh(params, okada_params) for params, okada_params in zip(samples, okada)])
+        return llh
+
+    def close(self):
+        """Stops the workers"""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
@@ -0,0 +1,110 @@
+"""
+Langevin and Hamiltonian proposals driven by the gradient of a surrogate posterior.
+"""
+import numpy as np
+
+
+class GradientProposal:
+    """
+    MALA and HMC proposals for the sample parameters. GeoClaw gives no gradient, so the drift of the Langevin
+    proposal and the leapfrog trajectories of the Hamiltonian proposal follow the gradient of a surrogate
+    log posterior: the prior gradient of the mcmc class (prior_grad) plus the finite difference gradient of a
+    cheap surrogate log likelihood (the linear Green's function forward model, see Scenario.surrogate_llh).
+    The proposals are then accepted with the GeoClaw likelihood and their proposal_log_ratio, so the chain
+    targets the exact posterior however rough the surrogate is: it only affects the acceptance rate.
+
+    Both are preconditioned by the covariance C of the mcmc class's random walk (proposal_covariance):
+        MALA: y = x + step^2/2 C grad(x) + step C^(1/2) xi
+        HMC: momentum p ~ N(0, C^-1), leapfrog_steps leapfrog steps of size step for H = -log pi~(x) + p^T C p / 2
+    """
+    def __init__(self, mcmc, surrogate_llh, mode='mala', step=1., leapfrog_steps=5, fd_scale=1.e-2):
+        """
+        :param mcmc: MCMC: provides sample_cols, prior_grad and proposal_covariance (Custom)
+        :param surrogate_llh: function of the sample parameters (pandas Series): surrogate log likelihood
+        :param mode: String: 'mala' or 'hmc'
+        :param step: float: step size, relative to the random walk steps
+        :param leapfrog_steps: Int: leapfrog steps of the HMC trajectories
+        :param fd_scale: float: finite difference step, relative to the random walk steps
+        """
+        if mode not in ('mala', 'hmc'):
+            raise ValueError("Unknown gradient proposal: " + str(mode))
+        missing = [name for name in ('proposal_covariance', 'prior_grad') if not hasattr(mcmc, name)]
+        if len(missing) > 0:
+            raise ValueError("Gradient proposals need " + " and ".join(missing) + ", which "
+                             + type(mcmc).__name__ + " does not provide")
+        self.mcmc = mcmc
+        self.cols = mcmc.sample_cols
+        self.surrogate_llh = surrogate_llh
+        self.mode = mode
+        self.step = step
+        self.leapfrog_steps = leapfrog_steps
+        self.cov = np.asarray(mcmc.proposal_covariance(), dtype=float)
+        self.cov_sqrt = np.linalg.cholesky(self.cov)
+        self.fd_steps = fd_scale * np.sqrt(np.diag(self.cov))
+        # gradients of the last points, keyed by their parameters
+        self.cache = {}
+
+    def grad(self, params):
+        """
+        Gradient of the surrogate log posterior. Components whose finite differences are not finite
+        (off the fault) only have the prior gradient.
+        :param params: pandas Series: sample parameters
+        :return: (d,) array
+        """
+        x = params[self.cols].to_numpy(dtype=float)
+        key = x.tobytes()
+        if key in self.cache:
+            return self.cache[key]
+
+        grad = np.asarray(self.mcmc.prior_grad(params), dtype=float)
+        for i, h in enumerate(self.fd_steps):
+            ends = []
+            for sgn in [1, -1]:
+                point = params.copy()
+                point[self.cols[i]] = x[i] + sgn * h
+                ends.append(self.surrogate_llh(point))
+            diff = (ends[0] - ends[1]) / (2 * h)
+            if np.isfinite(diff):
+                grad[i] += diff
+
+        if len(self.cache) >= 4:
+            self.cache.pop(next(iter(self.cache)))
+        self.cache[key] = grad
+        return grad
+
+    def with_values(self, params, x):
+        new_params = params.copy()
+        new_params[self.cols] = x
+        return new_params
+
+    def log_q(self, x, y, grad_x):
+        """Log density of the MALA proposal from x to y, up to its normalization"""
+        r = np.linalg.solve(self.cov_sqrt, y - x - self.step**2 / 2 * self.cov @ grad_x)
+        return -0.5 * r @ r / self.step**2
+
+    def draw(self, prev_draw):
+        """
+        Draws a proposal
+        :param prev_draw: pandas Series: current sample parameters
+        :return: proposal (pandas Series), log q(sample | proposal) - log q(proposal | sample)
+        """
+        x = prev_draw[self.cols].to_numpy(dtype=float)
+        grad_x = self.grad(prev_draw)
+
+        if self.mode == 'mala':
+            y = x + self.step**2 / 2 * self.cov @ grad_x + self.step * self.cov_sqrt @ np.random.randn(len(x))
+            proposal = self.with_values(prev_draw, y)
+            return proposal, self.log_q(y, x, self.grad(proposal)) - self.log_q(x, y, grad_x)
+
+        # leapfrog with the kinetic energy p^T C p / 2, the momentum flip makes it reversible
+        p = np.linalg.solve(self.cov_sqrt.T, np.random.randn(len(x)))
+        kinetic = 0.5 * p @ self.cov @ p
+        y, grad_y = x.copy(), grad_x
+        p = p + self.step / 2 * grad_y
+        for i in range(self.leapfrog_steps):
+            y = y + self.step * self.cov @ p
+            grad_y = self.grad(self.with_values(prev_draw, y))
+            if i < self.leapfrog_steps - 1:
+                p = p + self.step * grad_y
+        p = p + self.step / 2 * grad_y
+        return self.with_values(prev_draw, y), kinetic - 0.5 * p @ self.cov @ p
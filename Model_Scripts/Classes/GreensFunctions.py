@@ -0,0 +1,205 @@
+"""
+Linear Green's function forward model for the gauges.
+"""
+
+import os
+import sys
+import json
+import glob
+import numpy as np
+
+from UnitSources import UnitSources
+
+
+class GreensFunctions:
+    """
+    Database of the tsunami waveforms at the gauges due to each unit source of the UnitSources library.
+
+    Away from the coast the shallow water equations are nearly linear, so the waveform of a rupture is
+    approximately the slip weighted sum of the unit source waveforms. The database is built once by running
+    GeoClaw for every unit source (a parallel campaign, see run_campaign), and then a proposal's maximum
+    heights and arrival times at the gauges come from a sum over the patches it covers, without a GeoClaw run.
+
+    Only one depth layer of the library is run, so the waveforms ignore the DeltaDepth offset, and the coastal
+    nonlinearity is missing: use it as a fast approximate likelihood, e.g., for the first stage of delayed acceptance.
+    """
+    def __init__(self, path='./InputData/greens', unit_sources=None):
+        """
+        :param path: String: database path without extension (path.npy holds the waveforms, path.npz the index)
+        :param unit_sources: UnitSources: the library the database was built from (loaded if not given)
+        """
+        index = np.load(path + '.npz')
+        self.waveforms = np.load(path + '.npy', mmap_mode='r')
+        self.nodes = index['nodes']
+        self.times = index['times']
+        self.unit_sources = UnitSources() if unit_sources is None else unit_sources
+
+        # database row of each library node, -1 for nodes that were not run
+        self.row = -np.ones(len(self.unit_sources.node_lat), dtype=int)
+        self.row[self.nodes] = np.arange(len(self.nodes))
+
+    @staticmethod
+    def time_grid(dt=15.):
+        """
+        Times at which the waveforms are stored: every dt seconds over the run time in model_bounds
+        :return: array of times (s)
+        """
+        with open('./PreRun/InputData/model_bounds.txt') as json_file:
+            model_bounds = json.load(json_file)
+        return np.arange(0., model_bounds['run_time'] * 60. + dt/2, dt)
+
+    @staticmethod
+    def gauge_series(num_gauges):
+        """
+        Reads the GeoClaw gauge output (fort.gauge or gaugeXXXXX.txt files), also while GeoClaw is still
+        writing it: incomplete lines are skipped
+        :param num_gauges: Int: number of gauges (numbered 0, ..., num_gauges-1)
+        :return: list of (n, 4) arrays of the level, time (s), depth (m) and surface elevation (m) of each gauge's records
+        """
+        def records(fname, columns):
+            rows = []
+            try:
+                f = open(fname)
+            except OSError:
+                return np.zeros((0, columns))
+            with f:
+                for line in f:
+                    values = line.split()
+                    if len(values) != columns or line.lstrip().startswith('#'):
+                        continue
+                    try:
+                        rows.append([float(v) for v in values])
+                    except ValueError:
+                        continue
+            return np.array(rows).reshape(-1, columns)
+
+        # columns: [gauge,] level, t, h, hu, hv, eta
+        if os.path.isfile('fort.gauge'):
+            data = records('fort.gauge', 7)
+            series = [data[data[:, 0] == i, 1:] for i in range(num_gauges)]
+        else:
+            series = [records('gauge%05i.txt' % i, 6) for i in range(num_gauges)]
+        return [data[:, [0, 1, 2, -1]] for data in series]
+
+    @staticmethod
+    def read_gauge_output(num_gauges, times):
+        """
+        Reads the GeoClaw gauge output and interpolates the surface elevation of each gauge to times,
+        taking the finest level available at each output time
+        :param num_gauges: Int: number of gauges (numbered 0, ..., num_gauges-1)
+        :param times: array of times (s)
+        :return: (num_gauges, len(times)) array of surface elevations (m)
+        """
+        eta = np.zeros((num_gauges, len(times)))
+        for i, data in enumerate(GreensFunctions.gauge_series(num_gauges)):
+            if len(data) == 0:
+                continue
+            order = np.lexsort((-data[:, 0], data[:, 1]))
+            t, first = np.unique(data[order, 1], return_index=True)
+            eta[i] = np.interp(times, t, data[order, -1][first], left=0.)
+        return eta
+
+    @staticmethod
+    def run_campaign(rank=0, size=1, path='./InputData/greens', layer=None, dt=15.):
+        """
+        Runs GeoClaw for the unit sources k = rank, rank+size, ... of the library, from a run directory set up
+        by Main.py, and saves each source's gauge waveforms to path_sources/source_k.npy. Run one worker per
+        rank (e.g., one SLURM array task each), then call assemble.
+        :param rank: Int: index of this worker
+        :param size: Int: number of workers
+        :param path: String: database path without extension
+        :param layer: Int: depth layer of the library to run (default: the layer with offset 0)
+        :param dt: float: time step of the stored waveforms (s)
+        :return: None
+        """
+        from clawpack.geoclaw import dtopotools
+        sys.path.append('./PreRun/Classes/')
+        from Gauge import from_json
+
+        unit_sources = UnitSources()
+        if layer is None:
+            layer = int(np.argmin(np.abs(unit_sources.offsets)))
+        gauges = [from_json(gauge) for gauge in np.load('./PreRun/InputData/gauges.npy', allow_pickle=True)]
+        times = GreensFunctions.time_grid(dt)
+
+        # setrun.py adds these as GeoClaw gauges
+        with open('./InputData/greens_gauges.json', 'w') as f:
+            json.dump([[i, gauge.longitude, gauge.latitude] for i, gauge in enumerate(gauges)], f)
+        os.environ['GAUGES_FILE'] = './InputData/greens_gauges.json'
+        os.system('rm .data')
+
+        outdir = path + '_sources'
+        os.makedirs(outdir, exist_ok=True)
+        n = 2*unit_sources.half_width + 1
+        for k in range(rank, len(unit_sources.node_lat), size):
+            fname = os.path.join(outdir, 'source_%i.npy' % k)
+            if os.path.isfile(fname):
+                continue
+            print("Green's functions: unit source", k, "of", len(unit_sources.node_lat))
+
+            # unit slip deformation of source k on the dtopo grid
+            dz = np.zeros((len(unit_sources.y) + 2*n, len(unit_sources.x) + 2*n))
+            r0, c0 = unit_sources.window[k] + n
+            dz[r0:r0+n, c0:c0+n] = unit_sources.fields[layer, k]
+            dtopo = dtopotools.DTopography()
+            dtopo.x, dtopo.y = unit_sources.x, unit_sources.y
+            dtopo.X, dtopo.Y = np.meshgrid(dtopo.x, dtopo.y)
+            dtopo.times = [1.]
+            dtopo.dZ = dz[np.newaxis, n:-n, n:-n]
+            os.system('rm ./InputData/dtopo.tt3')
+            dtopo.write('./InputData/dtopo.tt3', dtopo_type=3)
+
+            os.system('rm -f fort.gauge gauge*.txt')
+            os.system('rm .output')
+            os.system('make .output')
+            np.save(fname, GreensFunctions.read_gauge_output(len(gauges), times).astype(np.float32))
+
+    @staticmethod
+    def assemble(path='./InputData/greens', dt=15.):
+        """
+        Collects the waveforms written by run_campaign into the database path.npy/path.npz
+        :param path: String: database path without extension
+        :param dt: float: time step used for the campaign (s)
+        :return: None
+        """
+        files = glob.glob(os.path.join(path + '_sources', 'source_*.npy'))
+        nodes = np.array(sorted(int(os.path.basename(f)[7:-4]) for f in files), dtype=int)
+        first = np.load(os.path.join(path + '_sources', 'source_%i.npy' % nodes[0]))
+        waveforms = np.lib.format.open_memmap(path + '.npy.tmp', mode='w+', dtype=np.float32,
+                                              shape=(len(nodes),) + first.shape)
+        for row, k in enumerate(nodes):
+            waveforms[row] = np.load(os.path.join(path + '_sources', 'source_%i.npy' % k))
+        waveforms.flush()
+        del waveforms
+        os.rename(path + '.npy.tmp', path + '.npy')
+        np.savez(path + '.npz', nodes=nodes, times=GreensFunctions.time_grid(dt))
+
+    def predict(self, okada_params, arrival_tol=1.e-2):
+        """
+        Maximum surface elevations and arrival times at the gauges by linear superposition
+        :param okada_params: pandas Series: okada parameters (see map_to_okada)
+        :param arrival_tol: float: the wave arrives when the elevation first exceeds this (m), as for fgmax
+        :return: arrivals (minutes, inf if the wave does not arrive), heights (m)
+        """
+        node, layer, w0, w1 = self.unit_sources.node_weights(okada_params)
+        rows = self.row[node]
+        if np.any(rows < 0):
+            print("WARNING: {:.1%} of the rupture has no Green's functions".format(np.mean(rows < 0)))
+        weights = np.bincount(rows[rows >= 0], weights=(w0 + w1)[rows >= 0], minlength=len(self.nodes))
+
+        used = np.nonzero(weights)[0]
+        eta = okada_params['Slip'] * np.tensordot(weights[used], self.waveforms[used], axes=1)
+
+        heights = eta.max(axis=1)
+        arrived = eta > arrival_tol
+        arrivals = np.where(arrived.any(axis=1), self.times[np.argmax(arrived, axis=1)] / 60., np.inf)
+        return arrivals, heights
+
+
+if __name__ == '__main__':
+    # e.g., from a run directory: python Classes/GreensFunctions.py $SLURM_ARRAY_TASK_ID $SLURM_ARRAY_TASK_COUNT
+    #       and, once all tasks are done: python Classes/GreensFunctions.py assemble
+    if sys.argv[1] == 'assemble':
+        GreensFunctions.assemble()
+    else:
+        GreensFunctions.run_campaign(int(sys.argv[1]), int(sys.argv[2]))
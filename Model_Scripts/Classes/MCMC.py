@@ -43,6 +43,14 @@ class MCMC:
         print("proposal_llh is:")
         print(proposal_llh)
 
+        return self.llh_difference(proposal_llh, sample_llh)
+
+    @staticmethod
+    def llh_difference(proposal_llh, sample_llh):
+        """
+        Difference proposal_llh - sample_llh, with the conventions for -inf and nan loglikelihoods
+        :return:
+        """
         if np.isneginf(proposal_llh) and np.isneginf(sample_llh):
             change_llh = 0
         elif np.isnan(proposal_llh) and np.isnan(sample_llh):
@@ -56,13 +64,75 @@ class MCMC:
             change_llh = proposal_llh - sample_llh
         return change_llh
 
-    def accept_reject(self, accept_prob):
+    def coarse_acceptance_prob(self, cur_prior_lpdf, prop_prior_lpdf):
+        """
+        First stage of the delayed acceptance (multilevel) MCMC: the acceptance probability
+        of the proposal under the coarse (truncated AMR) posterior. Only proposals that pass
+        this stage are run on the full AMR hierarchy.
+
+        :param cur_prior_lpdf: current parameters prior logpdf
+        :param prop_prior_lpdf: proposed parameters prior logpdf
+        :return:
+        """
+        change_llh = self.llh_difference(self.samples.get_proposal_coarse_llh(), self.samples.get_sample_coarse_llh())
+        return min(1, np.exp(change_llh + prop_prior_lpdf - cur_prior_lpdf + self.samples.proposal_log_ratio))
+
+    def fine_acceptance_prob(self, cur_prior_lpdf, prop_prior_lpdf):
+        """
+        Second stage of the delayed acceptance (multilevel) MCMC. The fine likelihood ratio
+        is corrected by the coarse ratio already used in the first stage,
+            min(1, [L_f(y)/L_f(x)] / [L_c(y)/L_c(x)]),
+        so the chain still targets the full-resolution posterior exactly. This requires the
+        coarse likelihood to be positive wherever the fine one is; if the current coarse
+        likelihood is zero the ordinary Metropolis ratio is used instead.
+
+        :param cur_prior_lpdf: current parameters prior logpdf
+        :param prop_prior_lpdf: proposed parameters prior logpdf
+        :return:
+        """
+        change_llh = self.change_llh_calc()
+        change_coarse_llh = self.llh_difference(self.samples.get_proposal_coarse_llh(), self.samples.get_sample_coarse_llh())
+        if not np.isfinite(change_coarse_llh):
+            log_prob = change_llh + prop_prior_lpdf - cur_prior_lpdf + self.samples.proposal_log_ratio
+        else:
+            log_prob = change_llh - change_coarse_llh
+        if np.isnan(log_prob):
+            return 0
+        return min(1, np.exp(log_prob))
+
+    def log_acceptance_bound(self, llh_bound, cur_prior_lpdf, prop_prior_lpdf, stage=None):
+        """
+        Largest log acceptance probability the proposal can reach before its loglikelihood is known.
+        A uniform random number drawn in advance whose log is at least this bound rejects the proposal
+        whatever its loglikelihood, so the forward model does not need to be run.
+
+        :param llh_bound: float: upper bound on the proposal loglikelihood
+        :param cur_prior_lpdf: current parameters prior logpdf
+        :param prop_prior_lpdf: proposed parameters prior logpdf
+        :param stage: None for the Metropolis acceptance, 'coarse' or 'fine' for the stages of the delayed acceptance
+        :return:
+        """
+        if stage == 'coarse':
+            change_llh = self.llh_difference(llh_bound, self.samples.get_sample_coarse_llh())
+            return change_llh + prop_prior_lpdf - cur_prior_lpdf + self.samples.proposal_log_ratio
+
+        change_llh = self.llh_difference(llh_bound, self.samples.get_sample_llh())
+        if stage == 'fine':
+            change_coarse_llh = self.llh_difference(self.samples.get_proposal_coarse_llh(), self.samples.get_sample_coarse_llh())
+            if np.isfinite(change_coarse_llh):
+                return change_llh - change_coarse_llh
+        return change_llh + prop_prior_lpdf - cur_prior_lpdf + self.samples.proposal_log_ratio
+
+    def accept_reject(self, accept_prob, u=None):
         """
         Decides to accept or reject the proposal. Saves the accepted parameters as new current sample
         :param accept_prob: float Proposal acceptance probability
+        :param u: float: uniform random number drawn before the proposal was evaluated (drawn here if not given)
         :return:
         """
-        if np.random.random() < accept_prob:
+        if u is None:
+            u = np.random.random()
+        if u < accept_prob:
             # Accept and save proposal
             ar = True
             self.samples.accepts += 1
@@ -76,6 +146,74 @@ class MCMC:
         self.samples.accepted = ar
         return ar
 
+    def prior_sample(self, n, steps=50):
+        """
+        Draws n samples of the prior for the population samplers. The draws of prior.rvs are not exact
+        draws of the prior density (see prior_logpdf), so each is moved by steps Metropolis steps of draw
+        targeting the prior, which needs no forward model runs.
+        :param n: Int: number of samples
+        :param steps: Int: Metropolis steps per sample
+        :return: list of pandas Series, (n,) array of prior logpdfs
+        """
+        samples, prior = [], []
+        while len(samples) < n:
+            params = self.prior.rvs()
+            lpdf = self.prior_logpdf(params)
+            if np.isfinite(lpdf):
+                samples.append(params)
+                prior.append(lpdf)
+        prior = np.array(prior)
+        for step in range(steps):
+            for i in range(n):
+                proposal = self.draw(samples[i])
+                lpdf = self.prior_logpdf(proposal)
+                if np.isfinite(lpdf) and np.log(np.random.random()) < lpdf - prior[i] + self.log_proposal_ratio(samples[i], proposal):
+                    samples[i], prior[i] = proposal, lpdf
+        return samples, prior
+
+    def stretch_move(self, walker, other, a=2.):
+        """
+        Affine invariant stretch move (Goodman and Weare, 2010): proposes walker + (z - 1)(walker - other)
+        with z drawn from g(z) ~ 1/sqrt(z) on [1/a, a]
+        :param walker: pandas Series: sample parameters of the walker to move
+        :param other: pandas Series: sample parameters of a walker of the complementary half of the ensemble
+        :param a: float: stretch scale
+        :return: proposal (pandas Series), log of the proposal correction z^(d-1) of the acceptance ratio
+        """
+        cols = self.sample_cols
+        z = ((a - 1.) * np.random.random() + 1.)**2 / a
+        proposal = walker.copy()
+        proposal[cols] = other[cols].to_numpy(dtype=float) + z * (walker[cols].to_numpy(dtype=float) - other[cols].to_numpy(dtype=float))
+        return proposal, (len(cols) - 1) * np.log(z)
+
+    def de_draw(self, prev_draw, states, jump=0.1, noise=1.e-3):
+        """
+        Differential evolution proposal (DE-MC, ter Braak 2006): a jump along the difference of two
+        archived states of other chains, prev_draw + gamma (z1 - z2) + e. The archived states follow
+        the scale and correlations of the posterior, so the jumps are tuned without adaptation.
+        The proposal is symmetric, so the Metropolis acceptance is unchanged.
+        :param prev_draw: pandas Series: current sample parameters
+        :param states: (n, d) array of archived states of the other chains (see Archive.states)
+        :param jump: float: probability of gamma = 1 (jumps between modes) instead of 2.38/sqrt(2d)
+        :param noise: float: standard deviation of e relative to the spread of the states
+        :return: pandas Series: proposal
+        """
+        cols = self.sample_cols
+        d = len(cols)
+        gamma = 1. if np.random.random() < jump else 2.38 / np.sqrt(2 * d)
+        z = states[np.random.choice(len(states), 2, replace=False)]
+        new_draw = prev_draw.copy()
+        new_draw[cols] = prev_draw[cols].to_numpy(dtype=float) + gamma * (z[0] - z[1]) + \
+            np.random.normal(0., noise * states.std(axis=0) + 1.e-12)
+        return new_draw
+
+    def log_proposal_ratio(self, sample_params, proposal_params):
+        """
+        log q(sample | proposal) - log q(proposal | sample) of draw, the correction of the acceptance
+        probability for an asymmetric proposal (0 for a symmetric random walk)
+        """
+        return 0.
+
     def map_to_okada(self, draws):
         pass
 
@@ -0,0 +1,142 @@
+"""
+Sequential Monte Carlo sampler with a population of forward model runs per stage.
+"""
+import numpy as np
+import pandas as pd
+from scipy.special import logsumexp
+
+from ForwardPool import ForwardPool
+
+
+class SMC:
+    """
+    Sequential Monte Carlo with likelihood tempering. A population of particles moves from the prior to the
+    posterior through the tempered posteriors prior * likelihood^beta, 0 = beta_0 < ... < beta_T = 1. Each stage
+        - picks the next beta so the effective sample size of the incremental weights likelihood^(beta' - beta)
+          is ess_fraction of the population,
+        - resamples the particles by these weights (systematic resampling),
+        - moves each particle with a few Metropolis steps of Custom.draw targeting the tempered posterior.
+    The forward model runs of a stage are independent, so they are spread over a pool of workers (see ForwardPool).
+    The product of the mean incremental weights estimates the evidence (relative to the normalization of the
+    prior, which is not normalized here).
+    """
+    def __init__(self, scenario, num_particles=100, num_workers=1, ess_fraction=0.5, mcmc_steps=3, prior_steps=50):
+        """
+        :param scenario: Scenario: provides the Custom mcmc class (prior, draw, map_to_okada), gauges and feedForward
+        :param num_particles: Int: population size
+        :param num_workers: Int: number of forward model workers (GeoClaw runs at a time)
+        :param ess_fraction: float: target effective sample size of each stage as a fraction of num_particles
+        :param mcmc_steps: Int: Metropolis steps per particle and stage
+        :param prior_steps: Int: Metropolis steps targeting the prior that turn the initial draws of prior.rvs
+            (not exact draws of the prior density) into a prior sample
+        """
+        self.scenario = scenario
+        self.mcmc = scenario.mcmc
+        self.num_particles = num_particles
+        self.num_workers = num_workers
+        self.ess_fraction = ess_fraction
+        self.mcmc_steps = mcmc_steps
+        self.prior_steps = prior_steps
+        self.save_path = scenario.samples.save_path + 'smc_'
+        self.forward_pool = ForwardPool(scenario, num_workers)
+
+    def log_likelihoods(self, particles):
+        """
+        Log likelihoods of a list of particles, running the forward model of each in parallel
+        :param particles: list of pandas Series of sample parameters
+        :return: (n,) array
+        """
+        return self.forward_pool.log_likelihoods(particles)
+
+    def next_beta(self, beta, llh):
+        """
+        Next temperature: the largest beta' <= 1 for which the effective sample size of the weights
+        exp((beta' - beta) * llh) is at least ess_fraction of the particles with a finite likelihood
+        :return: float
+        """
+        llh = llh[np.isfinite(llh)]
+        if len(llh) == 0:
+            raise ValueError("SMC: no particle has a finite likelihood")
+
+        def ess(delta):
+            w = np.exp(delta * (llh - llh.max()))
+            return w.sum()**2 / (w**2).sum()
+
+        target = self.ess_fraction * len(llh)
+        if ess(1. - beta) >= target:
+            return 1.
+        lo, hi = 0., 1. - beta
+        for _ in range(60):
+            mid = (lo + hi) / 2
+            if ess(mid) >= target:
+                lo = mid
+            else:
+                hi = mid
+        return beta + lo
+
+    @staticmethod
+    def resample(logw):
+        """Systematic resampling: indices of the resampled particles"""
+        w = np.exp(logw - logsumexp(logw))
+        positions = (np.random.random() + np.arange(len(w))) / len(w)
+        return np.minimum(np.searchsorted(np.cumsum(w), positions), len(w) - 1)
+
+    def save_stage(self, stage, beta, particles, prior, llh, ess, acceptance, log_evidence):
+        """Appends the population and the summary of a stage to smc_particles.csv and smc_stages.csv"""
+        population = pd.DataFrame([params[self.mcmc.sample_cols].tolist() for params in particles], columns=self.mcmc.sample_cols)
+        population.insert(0, 'Beta', beta)
+        population.insert(0, 'Stage', stage)
+        population['Prior'] = prior
+        population['LLH'] = llh
+        population.to_csv(self.save_path + 'particles.csv', mode='a', header=(stage == 0), index=False)
+
+        summary = pd.DataFrame([[stage, beta, ess, acceptance, log_evidence]],
+                               columns=['Stage', 'Beta', 'ESS', 'Acceptance Rate', 'Log Evidence'])
+        summary.to_csv(self.save_path + 'stages.csv', mode='a', header=(stage == 0), index=False)
+
+    def run(self):
+        """
+        Runs the sampler until beta = 1
+        :return: list of posterior particles, log evidence estimate
+        """
+        particles, prior = self.mcmc.prior_sample(self.num_particles, self.prior_steps)
+        llh = self.log_likelihoods(particles)
+        beta, log_evidence, stage = 0., 0., 0
+        self.save_stage(stage, beta, particles, prior, llh, self.num_particles, np.nan, log_evidence)
+
+        while beta < 1.:
+            new_beta = self.next_beta(beta, llh)
+            logw = np.where(np.isfinite(llh), (new_beta - beta) * llh, np.NINF)
+            log_evidence += logsumexp(logw) - np.log(len(logw))
+            ess = np.exp(2*logsumexp(logw) - logsumexp(2*logw))
+            beta, stage = new_beta, stage + 1
+            print("SMC stage {}: beta = {:.4g}, ESS = {:.1f}, log evidence = {:.4g}".format(stage, beta, ess, log_evidence))
+
+            index = self.resample(logw)
+            particles = [particles[i].copy() for i in index]
+            prior, llh = prior[index], llh[index]
+
+            # rejuvenate with Metropolis steps targeting prior * likelihood^beta
+            accepted = 0
+            for step in range(self.mcmc_steps):
+                proposals = [self.mcmc.draw(params) for params in particles]
+                proposal_prior = np.array([self.mcmc.prior_logpdf(params) for params in proposals])
+                valid = np.nonzero(np.isfinite(proposal_prior))[0]
+                proposal_llh = np.full(len(proposals), np.NINF)
+                proposal_llh[valid] = self.log_likelihoods([proposals[i] for i in valid])
+
+                for i in valid:
+                    log_ratio = beta * (proposal_llh[i] - llh[i]) + proposal_prior[i] - prior[i] + \
+                        self.mcmc.log_proposal_ratio(particles[i], proposals[i])
+                    if np.isneginf(llh[i]) and np.isfinite(proposal_llh[i]):
+                        log_ratio = np.inf
+                    if np.log(np.random.random()) < log_ratio:
+                        particles[i], prior[i], llh[i] = proposals[i], proposal_prior[i], proposal_llh[i]
+                        accepted += 1
+            acceptance = accepted / (self.mcmc_steps * self.num_particles)
+            print("SMC stage {}: acceptance rate {:.3f}".format(stage, acceptance))
+            self.save_stage(stage, beta, particles, prior, llh, ess, acceptance, log_evidence)
+
+        self.forward_pool.close()
+        print("SMC log evidence:", log_evidence)
+        return particles, log_evidence
@@ -68,7 +68,8 @@ class Samples:
         mcmc_cols = sample_cols + proposal_cols + okada_cols + proposal_okada_cols + \
                     ["Sample Prior", "Sample LLH", "Sample Posterior"] + \
                     ["Proposal Prior", "Proposal LLH", "Proposal Posterior"] + \
-                    ["Proposal Accept/Reject", "Acceptance Rate"]
+                    ["Proposal Accept/Reject", "Acceptance Rate"] + \
+                    ["Sample Coarse LLH", "Proposal Coarse LLH"]
 
         self.samples        = pd.DataFrame(columns=sample_cols)
         self.proposals      = pd.DataFrame(columns=proposal_cols)
@@ -97,6 +98,16 @@ class Samples:
         self.proposal_prior_lpdf = None
         self.proposal_posterior_lpdf = None
 
+        # loglikelihoods on the truncated AMR hierarchy (multilevel MCMC only)
+        self.sample_coarse_llh = np.nan
+        self.proposal_coarse_llh = np.nan
+
+        # the proposal's GeoClaw run was stopped by the watchdog (recorded as 'Timed Out' and rejected)
+        self.timed_out = False
+
+        # log q(sample | proposal) - log q(proposal | sample) of the proposal, 0 for a symmetric draw
+        self.proposal_log_ratio = 0.
+
     def load_csv(self):
         #TODO: test me
         """For restart functionality"""
@@ -107,6 +118,8 @@ class Samples:
 
         # initialize several class attributes
         self.sample_llh = self.mcmc["Sample LLH"].iloc[-1]
+        if "Sample Coarse LLH" in self.mcmc:
+            self.sample_coarse_llh = self.mcmc["Sample Coarse LLH"].iloc[-1]
 
     def save_sample(self, saves):
         """
@@ -211,6 +224,34 @@ class Samples:
         """
         return self.proposal_llh
 
+    def save_sample_coarse_llh(self, llh):
+        """
+        Saves the current sample loglikelihood on the truncated AMR hierarchy
+        :param llh: float: current sample coarse loglikelihood
+        """
+        self.sample_coarse_llh = llh
+
+    def get_sample_coarse_llh(self):
+        """
+        Returns the current sample loglikelihood on the truncated AMR hierarchy
+        :return: float: current sample coarse loglikelihood
+        """
+        return self.sample_coarse_llh
+
+    def save_proposal_coarse_llh(self, llh):
+        """
+        Saves the proposal loglikelihood on the truncated AMR hierarchy
+        :param llh: float: proposal coarse loglikelihood
+        """
+        self.proposal_coarse_llh = llh
+
+    def get_proposal_coarse_llh(self):
+        """
+        Returns the proposal loglikelihood on the truncated AMR hierarchy
+        :return: float: proposal coarse loglikelihood
+        """
+        return self.proposal_coarse_llh
+
     def save_sample_prior_lpdf(self, saves):
         """
         Saves the sample prior loglikelihood
@@ -280,9 +321,11 @@ class Samples:
         saves += [self.sample_prior_lpdf, self.sample_llh, self.sample_posterior_lpdf]
         saves += [self.proposal_prior_lpdf, self.proposal_llh, self.proposal_posterior_lpdf]
         if self.accepted: saves += ['Accepted']
+        elif self.timed_out: saves += ['Timed Out']
         else: saves += ['Rejected']
 
         saves += [self.accepts/(self.accepts+self.rejects)]
+        saves += [self.sample_coarse_llh, self.proposal_coarse_llh]
 
         self.mcmc.loc[len(self.mcmc)] = saves
 
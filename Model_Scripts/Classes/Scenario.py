@@ -4,6 +4,7 @@ Created 10/19/2018
 Property of BYU Mathematics Dept.
 """
 import os
+import time
 import numpy as np
 import pandas as pd
 import sys
@@ -18,6 +19,12 @@ from FeedForward import FeedForward
 from Custom import Custom
 from Gauge import from_json
 from Adjoint import Adjoint
+from SMC import SMC
+from Ensemble import Ensemble
+from Archive import Archive
+from DelayedRejection import DelayedRejection
+from GradientProposal import GradientProposal
+import convergence
 from pandas import read_pickle
 
 class Scenario:
@@ -27,16 +34,35 @@ class Scenario:
 	READ: Make sure you run the python notebook in the PreRun folder to generate necessary run files
 	"""
 
-	def __init__(self, title="Default_Title", use_custom=True, init='manual', adjoint=False, rw_covariance=1.0, method="random_walk", iterations=1):
+	def __init__(self, title="Default_Title", use_custom=True, init='manual', adjoint=False, rw_covariance=1.0, method="random_walk", iterations=1, shake=False, coarse_level=None, region_times=False, greens=False, timeout_factor=None, settle_window=None, early_reject=False, particles=100, workers=1, de_archive=None, dr_stages=None, fault_coords=False, gradient=None, gradient_step=None, target_ess=None, max_rhat=1.01, max_hours=None, chain_files=None, unit_sources=False):
 		"""
 		Initialize all the correct variables for Running this Scenario
 		:param title: Title for Scinerio (ex: 1852)
 		:param use_custom: Bool: To use the custom methods for MCMC or not
 		:param init: String: (manual, random or restart) How to initialize the parameters
 		:param rw_covariance: float: covariance for the random walk method
-		:param method: String: MCMC Method to use
+		:param method: String: MCMC Method to use ("smc" and "ensemble" run the sequential Monte Carlo and the affine invariant ensemble samplers with the custom methods)
 		:param iterations: Int: Number of Times to run the model
 		:param adjoint: Boolean: run the adjoint solver first or not
+		:param shake: Boolean: add the shake (MMI) log likelihood to the tsunami log likelihood
+		:param coarse_level: Int: if given, screen proposals with a GeoClaw run truncated at this AMR level before running the full hierarchy (two stage delayed acceptance)
+		:param region_times: Boolean: start the refinement regions shortly before the earliest possible arrival of each proposal
+		:param greens: Boolean: screen proposals with the linear Green's function forward model instead of a truncated GeoClaw run
+		:param timeout_factor: float: stop GeoClaw runs taking longer than this multiple of their predicted runtime and reject the proposal
+		:param settle_window: float: stop GeoClaw runs once the maxima at all fgmax points have not changed for this many simulated seconds
+		:param early_reject: Boolean: draw the acceptance random number first and skip the forward model for proposals that would be rejected even with the largest possible likelihood
+		:param particles: Int: population size of the sequential Monte Carlo sampler or number of walkers of the ensemble sampler
+		:param workers: Int: number of GeoClaw runs at a time for the population samplers
+		:param de_archive: String: archive file shared with the chains running at the same time, to propose differential evolution jumps between their states (see Archive)
+		:param dr_stages: Int: maximum number of delayed rejection stages per iteration, with the adaptive covariance (see DelayedRejection), None for the random walk of the mcmc class
+		:param fault_coords: Boolean: move the epicenter along strike and down dip in the Custom proposals (see Custom.use_fault_coordinates)
+		:param gradient: String: 'mala' or 'hmc' proposals following the gradient of the Green's function surrogate posterior (see GradientProposal), None for the random walk
+		:param gradient_step: float: step size of the gradient proposals relative to the random walk steps (None for the default)
+		:param target_ess: float: stop once the effective sample size of every parameter reaches target_ess and its split R-hat is at most max_rhat (None to run all the iterations)
+		:param max_rhat: float: largest split R-hat of a converged parameter
+		:param max_hours: float: stop after this wall time (hours), None for no limit
+		:param chain_files: String: glob pattern of the samples.csv files of the other chains of the run, for the ESS and R-hat over all the chains
+		:param unit_sources: Boolean: build the dtopo files from the unit source library (UnitSources) instead of Okada
 		"""
 
 		# Clean geoclaw files
@@ -54,7 +80,24 @@ class Scenario:
 		self.iterations = iterations
 		self.use_custom = use_custom
 		self.init = init
-		self.feedForward = FeedForward()
+		self.shake = shake
+		self.coarse_level = coarse_level
+		self.greens = greens
+		if greens and coarse_level is not None:
+			raise ValueError("Use either coarse_level or greens for the first stage")
+		self.two_stage = greens or coarse_level is not None
+		self.feedForward = FeedForward(region_times, timeout_factor, settle_window, unit_sources)
+		self.early_reject = early_reject
+		self.method = method
+		self.archive = None
+		self.dram = None
+		self.gradient_proposal = None
+		self.target_ess = target_ess
+		self.max_rhat = max_rhat
+		self.max_hours = max_hours
+		self.chain_files = chain_files
+		# iterations between convergence checks
+		self.check_every = 50
 
 		# Set the MCMC class based on input
 		if(use_custom):
@@ -64,6 +107,13 @@ class Scenario:
 		else:
 			self.mcmc = RandomWalk(rw_covariance)
 
+		if fault_coords:
+			if not use_custom:
+				raise ValueError("Fault-local proposal coordinates are only implemented for the Custom proposals")
+			if not hasattr(self.mcmc, 'use_fault_coordinates'):
+				raise ValueError("Fault-local proposal coordinates are not implemented for the " + title + " scenario (its Custom class has no use_fault_coordinates)")
+			self.mcmc.use_fault_coordinates()
+
 		# Get initial draw for the initial run of geoclaw
 		self.init_guesses = self.mcmc.init_guesses(self.init)
 
@@ -73,6 +123,23 @@ class Scenario:
 		if self.init == 'restart':
 			self.samples.load_csv()
 		self.mcmc.set_samples(self.samples)
+		if de_archive is not None:
+			self.archive = Archive(de_archive, os.path.basename(os.getcwd()), self.mcmc.sample_cols)
+		if dr_stages is not None:
+			if not use_custom:
+				raise ValueError("Delayed rejection is only implemented for the Custom proposals")
+			if self.two_stage or early_reject or de_archive is not None:
+				raise ValueError("Delayed rejection needs the likelihood of every rejected proposal of its own random walk: it cannot be combined with the coarse stage, the early rejection or the differential evolution proposals")
+			if fault_coords or gradient is not None:
+				raise ValueError("Delayed rejection proposes symmetric random walk steps of the sample parameters: it cannot be combined with the fault coordinate or gradient proposals")
+			self.dram = DelayedRejection(self.mcmc, dr_stages)
+		if gradient is not None:
+			if not use_custom:
+				raise ValueError("Gradient proposals are only implemented for the Custom proposals")
+			if not (os.path.isfile('./InputData/greens.npy') and os.path.isfile('./InputData/greens.npz')):
+				raise ValueError("Gradient proposals follow the Green's function surrogate, but there is no Green's function database (InputData/greens.npy and greens.npz, see GreensFunctions.run_campaign)")
+			kwargs = {} if gradient_step is None else {'step': gradient_step}
+			self.gradient_proposal = GradientProposal(self.mcmc, self.surrogate_llh, gradient, **kwargs)
 
 		# Make sure Pre-Run files have been generated
 		if(os.path.isfile(gauges_file_path)):
@@ -83,11 +150,22 @@ class Scenario:
 
 
 
-#        #test shake gauge input
-#        if(os.path.isfile(shake_gauges_file_path)):
-#            self.shake_gauges = read_pickle(shake_gauges_file_path)
-#        else:
-#            raise ValueError("Shake gauge file does not exist")
+		if self.shake:
+			if(os.path.isfile(shake_gauges_file_path)):
+				self.shake_gauges = read_pickle(shake_gauges_file_path)
+			else:
+				raise ValueError("Shake gauge file does not exist")
+
+		# Largest possible tsunami log likelihood, for the early rejection
+		self.llh_bound = self.feedForward.llh_upper_bound(self.gauges)
+
+		# JW: Create the adjoint object here...right now is given as a separate class
+		# (restarts too: this finds the cached solution, or solves again on a new node, and sets ADJOINT_OUTDIR)
+		if adjoint:
+			print("Starting adjoint computation")
+			self.adjoint = Adjoint()
+			self.adjoint.run_geo_claw()
+			print("Finished adjoint computation")
 
 		if self.init != 'restart':
 			# If using the custom methods map the initial guesses to okada parameters to save as initial sample
@@ -100,15 +178,15 @@ class Scenario:
 			# Load the samples
 			self.init_guesses = self.samples.get_sample()
 
-			# JW: Create the adjoint object here...right now is given as a separate class
-			if adjoint:
-				print("Starting adjoint computation")
-				self.adjoint = Adjoint()
-				self.adjoint.run_geo_claw()
-				print("Finished adjoint computation")
-
 			# Do initial run of GeoClaw using the initial guesses.
-			self.setGeoClaw()
+			if self.method not in ("smc", "ensemble"):
+				self.setGeoClaw()
+
+		# The population samplers replace the single chain of run
+		if self.method == "smc":
+			self.population = SMC(self, particles, workers)
+		elif self.method == "ensemble":
+			self.population = Ensemble(self, particles, workers)
 
 	def setGeoClaw(self):
 		"""
@@ -118,17 +196,184 @@ class Scenario:
 		# Get Okada parameters for initial guesses pandas data frame
 		okada_params = self.init_okada_params
 
-		# Run Geoclaw
-		self.feedForward.run_geo_claw(okada_params)
+		# Coarse log likelihood of the initial sample for the delayed acceptance
+		if self.two_stage:
+			sample_coarse_llh = self.coarse_llh(self.init_guesses, okada_params)
+			self.samples.save_sample_coarse_llh(sample_coarse_llh)
 
-		# Calculate the inital log likelihood and save result
-		sample_llh, sample_arr, sample_heights = self.feedForward.calculate_llh(self.gauges)
+		# Run Geoclaw and calculate the inital log likelihood and save result
+		sample_llh, sample_arr, sample_heights = self.forward_llh(self.init_guesses, okada_params)
 		self.samples.save_sample_llh(sample_llh)
 
 		# Now Save the observations based off the sample and the arrival times & wave heights
 		obvs = self.mcmc.make_observations(self.init_guesses, sample_arr, sample_heights)
 		self.samples.save_obvs(obvs)
 
+	def forward_llh(self, params, okada_params, amr_max_level=None):
+		"""
+		Runs GeoClaw and computes the log likelihood of a set of parameters
+		:param params: pandas Series: sample parameters
+		:param okada_params: pandas Series: okada parameters of the sample
+		:param amr_max_level: Int: finest AMR level to run, None for the full hierarchy
+		:return: log likelihood, arrival times, wave heights (-inf and nan if the run timed out)
+		"""
+		# Remove dtopo file for each run to generate a new one
+		os.system('rm ./InputData/dtopo.tt3')
+		if not self.feedForward.run_geo_claw(okada_params, amr_max_level):
+			# the watchdog stopped the run, see FeedForward.run_timeout
+			self.samples.timed_out = True
+			nans = np.full(len(self.gauges), np.nan)
+			return np.NINF, nans, nans
+
+		llh, arrivals, heights = self.feedForward.calculate_llh(self.gauges)
+
+		# Add the shake model log likelihood
+		if self.shake:
+			llh += self.shake_llh(params, okada_params)
+		return llh, arrivals, heights
+
+	def coarse_llh(self, params, okada_params):
+		"""
+		Cheap approximate log likelihood for the first stage of the delayed acceptance: a GeoClaw run
+		truncated at coarse_level, or the linear Green's function forward model
+		:param params: pandas Series: sample parameters
+		:param okada_params: pandas Series: okada parameters of the sample
+		:return: float: log likelihood
+		"""
+		if not self.greens:
+			return self.forward_llh(params, okada_params, self.coarse_level)[0]
+
+		return self.surrogate_llh(params, okada_params)
+
+	def surrogate_llh(self, params, okada_params=None):
+		"""
+		Log likelihood of the linear Green's function forward model (and the shake model)
+		:param params: pandas Series: sample parameters
+		:param okada_params: pandas Series: okada parameters of the sample (mapped from params if not given)
+		:return: float: log likelihood, -inf outside of the fault
+		"""
+		if okada_params is None:
+			if np.isneginf(self.mcmc.prior_logpdf(params)):
+				return np.NINF
+			okada_params = self.mcmc.map_to_okada(params)
+		llh = self.feedForward.calculate_llh(self.gauges, self.feedForward.run_greens(okada_params))[0]
+		if self.shake:
+			llh += self.shake_llh(params, okada_params)
+		return llh
+
+	def cannot_accept(self, u, params, okada_params, sample_prior_lpdf, proposal_prior_lpdf, stage=None):
+		"""
+		Whether a proposal is rejected with the pre-drawn uniform random number u whatever its likelihood:
+		even the largest possible tsunami log likelihood (and its exact shake log likelihood) would not be enough
+		:param u: float: uniform random number of the acceptance test
+		:param params: pandas Series: proposal parameters
+		:param okada_params: pandas Series: okada parameters of the proposal
+		:param stage: None for the Metropolis acceptance, 'coarse' or 'fine' for the delayed acceptance stages
+		:return: Boolean
+		"""
+		llh_bound = self.llh_bound
+		if self.shake:
+			llh_bound += self.shake_llh(params, okada_params)
+		return np.log(u) >= self.mcmc.log_acceptance_bound(llh_bound, sample_prior_lpdf, proposal_prior_lpdf, stage)
+
+	def draw(self, sample_params, de_prob=0.9, min_states=20):
+		"""
+		Draws a proposal: with a shared archive, a differential evolution jump with probability de_prob once the
+		other chains have min_states recent states in it, else the gradient proposal if any or the random walk of the mcmc class
+		:param sample_params: pandas Series: current sample parameters
+		:return: pandas Series: proposal (and its proposal_log_ratio saved in samples)
+		"""
+		self.samples.proposal_log_ratio = 0.
+		if self.archive is not None and np.random.random() < de_prob:
+			states = self.archive.states()
+			if len(states) >= min_states:
+				return self.mcmc.de_draw(sample_params, states)
+		if self.gradient_proposal is not None:
+			proposal_params, self.samples.proposal_log_ratio = self.gradient_proposal.draw(sample_params)
+			return proposal_params
+		proposal_params = self.mcmc.draw(sample_params)
+		self.samples.proposal_log_ratio = self.mcmc.log_proposal_ratio(sample_params, proposal_params)
+		return proposal_params
+
+	def reject_unevaluated(self):
+		"""
+		Records nan log likelihood and observations for a proposal that was rejected
+		without a full GeoClaw run, and rejects it
+		:return: False
+		"""
+		self.samples.save_proposal_llh(np.nan)
+		self.samples.save_proposal_posterior_lpdf(np.nan)
+		proposal_obvs = self.samples.get_sample_obvs().copy()
+		proposal_obvs[...] = np.nan
+		self.samples.save_obvs(proposal_obvs)
+		return self.mcmc.accept_reject(0)
+
+	def delayed_rejection(self, sample_params):
+		"""
+		One iteration of the delayed rejection adaptive Metropolis: proposals of decreasing step size are run until
+		one is accepted or the stage cap is reached. The last proposal is saved as the proposal of the iteration.
+		:param sample_params: pandas Series: current sample parameters
+		:return: Boolean: whether a proposal was accepted
+		"""
+		sample_prior_lpdf = self.mcmc.prior_logpdf(sample_params)
+		sample_llh = self.samples.get_sample_llh()
+		self.samples.save_sample_prior_lpdf(sample_prior_lpdf)
+		self.samples.save_sample_llh(sample_llh)
+		self.samples.save_sample_posterior_lpdf(sample_prior_lpdf + sample_llh)
+		self.samples.save_proposal_coarse_llh(np.nan)
+
+		points = [sample_params]
+		# nan log likelihoods (unevaluated or timed out runs) count as zero posterior density
+		log_post = [float(np.where(np.isnan(sample_prior_lpdf + sample_llh), np.NINF, sample_prior_lpdf + sample_llh))]
+		for stage in range(self.dram.stages):
+			self.samples.timed_out = False
+			proposal_params = self.dram.draw(sample_params, stage)
+			proposal_prior_lpdf = self.mcmc.prior_logpdf(proposal_params)
+			proposal_obvs = self.samples.get_sample_obvs().copy()
+			proposal_obvs[...] = np.nan
+
+			if proposal_prior_lpdf == np.NINF or np.isnan(proposal_prior_lpdf):
+				proposal_params_okada = self.samples.get_sample_okada().copy()
+				proposal_params_okada[...] = np.nan
+				proposal_llh = np.nan
+			else:
+				proposal_params_okada = self.mcmc.map_to_okada(proposal_params)
+				proposal_llh, proposal_arr, proposal_heights = self.forward_llh(proposal_params, proposal_params_okada)
+				print("_____stage_{}_proposal_llh_____".format(stage + 1), proposal_llh)
+				if self.samples.timed_out:
+					print("Rejected proposal: the GeoClaw run timed out")
+					proposal_llh = np.nan
+				else:
+					proposal_obvs = self.mcmc.make_observations(proposal_params, proposal_arr, proposal_heights)
+
+			points.append(proposal_params)
+			log_post.append(float(np.where(np.isnan(proposal_prior_lpdf + proposal_llh), np.NINF, proposal_prior_lpdf + proposal_llh)))
+			accept_prob = self.dram.acceptance_prob(log_post, points)
+			accepted = np.random.random() < accept_prob
+			self.dram.record(stage, accepted)
+			print("Delayed rejection stage {}: acceptance probability {:.4g}".format(stage + 1, accept_prob))
+			if accepted:
+				break
+
+		self.samples.save_proposal(proposal_params)
+		self.samples.save_proposal_okada(proposal_params_okada)
+		self.samples.save_proposal_prior_lpdf(proposal_prior_lpdf)
+		self.samples.save_proposal_llh(proposal_llh)
+		self.samples.save_proposal_posterior_lpdf(proposal_prior_lpdf + proposal_llh)
+		self.samples.save_obvs(proposal_obvs)
+		self.dram.save(self.samples.save_path + 'dram_stages.csv')
+		return self.mcmc.accept_reject(1 if accepted else 0)
+
+	def shake_llh(self, params, okada_params):
+		"""
+		Runs the vectorized shake model for all shake gauges and returns the shake log likelihood
+		:param params: pandas Series: sample parameters (must include Magnitude)
+		:param okada_params: pandas Series: okada parameters of the sample
+		:return: float: shake log likelihood
+		"""
+		MMI = self.feedForward.run_abrahamson(self.shake_gauges, params["Magnitude"], okada_params)
+		return self.feedForward.shake_llh(MMI, self.shake_gauges)
+
 	def clean_up(self):
 		"""
 		Cleans up the unnecessary clutter geoclaw outputs
@@ -138,19 +383,31 @@ class Scenario:
 
 	def run(self):
 		"""
-		Runs the Scenario For the given amount of iterations
+		Runs the Scenario For the given amount of iterations, or until the stopping rule is met (see should_stop)
 		"""
+		if self.method in ("smc", "ensemble"):
+			self.population.run()
+			return
+
+		start_time = time.time()
 		for i in range(self.iterations):
 
-			# Remove dtopo file for each run to generate a new one
-			os.system('rm ./InputData/dtopo.tt3')
+			# Stop once the chains have converged or the wall time is spent
+			if self.should_stop(i, start_time):
+				break
 
 			# Get current Sample and draw a proposal sample from it
 			sample_params = self.samples.get_sample()
-			proposal_params = self.mcmc.draw(sample_params)
+			if self.dram is not None:
+				ar = self.delayed_rejection(sample_params)
+				self.save_iteration(i, ar)
+				continue
+			proposal_params = self.draw(sample_params)
 
 			# Save the proposal draw for debugging purposes
 			self.samples.save_proposal(proposal_params)
+			self.samples.save_proposal_coarse_llh(np.nan)
+			self.samples.timed_out = False
 
 			# Calculate prior probability for the current sample and proposed sample
 			sample_prior_lpdf = self.mcmc.prior_logpdf(sample_params)
@@ -164,15 +421,7 @@ class Scenario:
 				proposal_params_okada = self.samples.get_sample_okada().copy()
 				proposal_params_okada[...] = np.nan
 				self.samples.save_proposal_okada(proposal_params_okada)
-				proposal_llh = np.nan
-				proposal_posterior_lpdf = np.nan
-				self.samples.save_proposal_llh(proposal_llh)
-				self.samples.save_proposal_posterior_lpdf(proposal_posterior_lpdf)
-				proposal_obvs = self.samples.get_sample_obvs().copy()
-				proposal_obvs[...] = np.nan
-				self.samples.save_obvs(proposal_obvs)
-				accept_prob = 0
-				ar = self.mcmc.accept_reject(accept_prob)
+				ar = self.reject_unevaluated()
 
 			else:
 				# If instructed to use the custom parameters, map parameters to Okada space (9 Dimensional)
@@ -184,64 +433,135 @@ class Scenario:
 				# Save Proposal
 				self.samples.save_proposal_okada(proposal_params_okada)
 
-				# Run Geo Claw on the new proposal
-				self.feedForward.run_geo_claw(proposal_params_okada)
-
-				"""
-				BEGIN SHAKE MODEL
-
-				#To speed up shake model calculation set this False
-				#            shake_option = True
-
-				#            print("init_guesses:")
-				#            print(self.init_guesses)
-				#            print(type(self.init_guesses))
-				#            self.proposal_MMI = self.feedForward.run_abrahamson(self.shake_gauges, self.init_guesses["Magnitude"], proposal_params_okada)
-				#            self.proposal_shake_llh = self.feedForward.shake_llh(self.proposal_MMI, self.shake_gauges, shake_option )
-				END SHAKE MODEL
-				"""
-
-				# Calculate the Log Likelihood for the new draw
-				proposal_llh, proposal_arr, proposal_heights = self.feedForward.calculate_llh(self.gauges)
-				sample_llh = self.samples.get_sample_llh()
-
-				# Save SHAKE STUFF
-				print("_____proposal_llh_____", proposal_llh)
-				#            proposal_llh += self.proposal_shake_llh
-				print("_____proposal_llh_____", proposal_llh)
-
-				self.samples.save_sample_llh(sample_llh)
-				self.samples.save_proposal_llh(proposal_llh)
-				proposal_obvs = self.mcmc.make_observations(proposal_params, proposal_arr, proposal_heights)
-				self.samples.save_obvs(proposal_obvs)
-
-				# Calculate the sample and proposal posterior log likelihood
-				sample_post_lpdf = sample_prior_lpdf + sample_llh
-				proposal_post_lpdf = proposal_prior_lpdf + proposal_llh
-				# Save
-				self.samples.save_sample_posterior_lpdf(sample_post_lpdf)
-				self.samples.save_proposal_posterior_lpdf(proposal_post_lpdf)
-
-				# Calculate the acceptance probability of the given proposal
-				accept_prob = self.mcmc.acceptance_prob(sample_params,proposal_params,sample_prior_lpdf, proposal_prior_lpdf)
-
-				# Decide to accept or reject the proposal and save
-				ar = self.mcmc.accept_reject(accept_prob)
-
-			# Saves the stored data for debugging purposes
-			self.samples.save_debug()
-
-			# Save to csv
-			if i % 1 == 0: #maybe change this back to 50?
-				self.samples.save_to_csv()
-
-			if ar:
-				self.samples.save_sample(self.samples.get_proposal())
-				self.samples.save_sample_okada(self.samples.get_proposal_okada())
-				self.samples.save_sample_llh(self.samples.get_proposal_llh())
-			else:
-				self.samples.save_sample(self.samples.get_sample())
-				self.samples.save_sample_okada(self.samples.get_sample_okada())
+				# Delayed acceptance: screen the proposal with a coarse run first
+				screened_out = False
+				if self.two_stage:
+					u = np.random.random()
+					if self.early_reject and self.cannot_accept(u, proposal_params, proposal_params_okada, sample_prior_lpdf, proposal_prior_lpdf, 'coarse'):
+						print("Rejected proposal before the coarse run: it cannot pass even with the largest possible likelihood")
+						screened_out = True
+						ar = self.reject_unevaluated()
+					else:
+						proposal_coarse_llh = self.coarse_llh(proposal_params, proposal_params_okada)
+						self.samples.save_proposal_coarse_llh(proposal_coarse_llh)
+						print("_____proposal_coarse_llh_____", proposal_coarse_llh)
+						coarse_prob = self.mcmc.coarse_acceptance_prob(sample_prior_lpdf, proposal_prior_lpdf)
+						if u >= coarse_prob:
+							print("Rejected proposal on the coarse level")
+							screened_out = True
+							ar = self.reject_unevaluated()
+
+				# Draw the acceptance random number first, and skip GeoClaw if the proposal cannot be accepted
+				u = np.random.random()
+				stage = 'fine' if self.two_stage else None
+				if not screened_out and self.early_reject and self.cannot_accept(u, proposal_params, proposal_params_okada, sample_prior_lpdf, proposal_prior_lpdf, stage):
+					print("Rejected proposal without running GeoClaw: it cannot be accepted even with the largest possible likelihood")
+					screened_out = True
+					ar = self.reject_unevaluated()
+
+				if not screened_out:
+					# Run Geo Claw on the new proposal and calculate the Log Likelihood for the new draw
+					proposal_llh, proposal_arr, proposal_heights = self.forward_llh(proposal_params, proposal_params_okada)
+
+					# A run stopped by the watchdog is rejected, as if the likelihood was 0
+					if self.samples.timed_out:
+						print("Rejected proposal: the GeoClaw run timed out")
+						ar = self.reject_unevaluated()
+
+					else:
+						sample_llh = self.samples.get_sample_llh()
+						print("_____proposal_llh_____", proposal_llh)
+
+						self.samples.save_sample_llh(sample_llh)
+						self.samples.save_proposal_llh(proposal_llh)
+						proposal_obvs = self.mcmc.make_observations(proposal_params, proposal_arr, proposal_heights)
+						self.samples.save_obvs(proposal_obvs)
+
+						# Calculate the sample and proposal posterior log likelihood
+						sample_post_lpdf = sample_prior_lpdf + sample_llh
+						proposal_post_lpdf = proposal_prior_lpdf + proposal_llh
+						# Save
+						self.samples.save_sample_posterior_lpdf(sample_post_lpdf)
+						self.samples.save_proposal_posterior_lpdf(proposal_post_lpdf)
+
+						# Calculate the acceptance probability of the given proposal
+						if self.two_stage:
+							accept_prob = self.mcmc.fine_acceptance_prob(sample_prior_lpdf, proposal_prior_lpdf)
+						else:
+							accept_prob = self.mcmc.acceptance_prob(sample_params,proposal_params,sample_prior_lpdf, proposal_prior_lpdf)
+
+						# Decide to accept or reject the proposal and save
+						ar = self.mcmc.accept_reject(accept_prob, u)
+
+			self.save_iteration(i, ar)
 
 		self.samples.save_to_csv()
 		return
+
+	def converged(self, i):
+		"""
+		Convergence check of the stopping rule: the ESS and split R-hat of each parameter over this chain and the
+		chains in chain_files (the first half of every chain is dropped as warm-up), appended to convergence.csv
+		:param i: Int: number of iterations done
+		:return: Boolean: whether every parameter reached target_ess and max_rhat
+		"""
+		cols = self.mcmc.sample_cols
+		chains = [self.samples.samples[cols].to_numpy(dtype=float)]
+		if self.chain_files is not None:
+			chains += convergence.load_chains(self.chain_files, cols, self.samples.save_path + "samples.csv")
+		table = convergence.summary(chains, cols)
+		if table is None:
+			return False
+
+		columns = ['Iteration', 'Chains'] + ['ESS ' + col for col in cols] + ['R-hat ' + col for col in cols]
+		row = pd.DataFrame([[i, len(chains)] + table['ESS'].tolist() + table['R-hat'].tolist()], columns=columns)
+		fname = self.samples.save_path + "convergence.csv"
+		row.to_csv(fname, mode='a', header=not os.path.isfile(fname), index=False)
+		print("Convergence after {} iterations of {} chains: min ESS {:.1f}, max R-hat {:.4f}".format(i, len(chains), table['ESS'].min(), table['R-hat'].max()))
+		return table['ESS'].min() >= self.target_ess and table['R-hat'].max() <= self.max_rhat
+
+	def should_stop(self, i, start_time):
+		"""
+		Stopping rule, checked before each iteration: the wall time limit, and every check_every iterations the
+		convergence of the chains (see converged). The number of iterations is the iteration cap.
+		:param i: Int: number of iterations done
+		:param start_time: float: time.time() at the start of the run
+		:return: Boolean
+		"""
+		if self.max_hours is not None and time.time() - start_time > 3600 * self.max_hours:
+			print("Stopping after {} iterations: wall time limit of {} hours reached".format(i, self.max_hours))
+			return True
+		if self.target_ess is not None and i > 0 and i % self.check_every == 0 and self.converged(i):
+			print("Stopping after {} iterations: target ESS {} reached".format(i, self.target_ess))
+			return True
+		return False
+
+	def save_iteration(self, i, ar):
+		"""
+		Saves the debug row of an iteration and the new current sample
+		:param i: Int: iteration
+		:param ar: Boolean: whether the proposal was accepted
+		"""
+		# Saves the stored data for debugging purposes
+		self.samples.save_debug()
+
+		# Save to csv
+		if i % 1 == 0: #maybe change this back to 50?
+			self.samples.save_to_csv()
+
+		if ar:
+			self.samples.save_sample(self.samples.get_proposal())
+			self.samples.save_sample_okada(self.samples.get_proposal_okada())
+			self.samples.save_sample_llh(self.samples.get_proposal_llh())
+			self.samples.save_sample_coarse_llh(self.samples.get_proposal_coarse_llh())
+		else:
+			self.samples.save_sample(self.samples.get_sample())
+			self.samples.save_sample_okada(self.samples.get_sample_okada())
+
+		# Share the new state with the other chains
+		if self.archive is not None:
+			self.archive.append(self.samples.get_sample())
+
+		# Adapt the proposal covariance of the delayed rejection
+		if self.dram is not None:
+			self.dram.adapt(self.samples.get_sample())
@@ -0,0 +1,208 @@
+"""
+Unit-slip deformation library for building dtopo files by linear superposition.
+"""
+
+import os
+import numpy as np
+from scipy.interpolate import RegularGridInterpolator
+
+from shake import subfault_arrays
+from travel_time import rupture_points
+
+
+class UnitSources:
+    """
+    Library of sea floor deformations of unit-slip patches on a lattice over the fault grid.
+
+    Okada deformation is linear in slip, so the deformation of a rupture with uniform slip is the slip times
+    the sum of the deformations of the lattice patches it covers. Each patch covers one lattice cell in map view,
+    follows the fault's strike, dip and depth at the lattice node and is stored for several depth offsets
+    (the DeltaDepth parameter), each on a window of the dtopo grid around the node. The fields are kept in a
+    memory-mapped .npy file, so a proposal only reads the patches it touches.
+
+    This approximates the rupture by lattice patches, with errors of the order of the lattice spacing at
+    the rupture edges. Build the library once with UnitSources.build; the runs only use it instead of Okada
+    when asked to (Main.py --unitsources), and then report its error on the first run (see okada_error).
+    """
+    def __init__(self, path='./InputData/unit_sources'):
+        """
+        :param path: String: library path without extension (path.npy holds the fields, path.npz the index)
+        """
+        index = np.load(path + '.npz')
+        self.fields = np.load(path + '.npy', mmap_mode='r')
+        self.node_lat = index['node_lat']
+        self.node_lon = index['node_lon']
+        self.node_depth = index['node_depth']
+        self.node_area = index['node_area']
+        self.window = index['window']
+        self.offsets = index['offsets']
+        self.lattice_lat = index['lattice_lat']
+        self.lattice_lon = index['lattice_lon']
+        self.lattice_node = index['lattice_node']
+        self.x = index['x']
+        self.y = index['y']
+        self.rake = float(index['rake'])
+        self.half_width = (self.fields.shape[-1] - 1) // 2
+
+        # fault depth on the lattice (nan off the library), to get the depth offset of each subfault
+        depth = np.full(self.lattice_node.shape, np.nan)
+        depth[self.lattice_node >= 0] = self.node_depth[self.lattice_node[self.lattice_node >= 0]]
+        self.depth_map = RegularGridInterpolator((self.lattice_lat, self.lattice_lon), depth, bounds_error=False)
+
+    @staticmethod
+    def build(path='./InputData/unit_sources', fault_file='./InputData/bandadata.npz', stride=2,
+              offsets=(-10000., -5000., 0., 5000., 10000.), max_depth=80000., half_width=40, rake=90.):
+        """
+        Computes the library with Okada and writes it to path.npy and path.npz
+        :param path: String: library path without extension
+        :param fault_file: String: fault grid (lat, lon, depth, dip, strike) as used by Custom.build_fault
+        :param stride: Int: use every stride-th node of the fault grid
+        :param offsets: depth offsets (m) of the stored layers
+        :param max_depth: float: skip nodes with a deeper fault (m)
+        :param half_width: Int: half width of the stored windows in dtopo grid cells
+        :param rake: float: rake of the unit patches
+        :return: None
+        """
+        from clawpack.geoclaw import dtopotools
+        from maketopo import dtopo_grid
+
+        data = np.load(fault_file)
+        lat, lon = data['lat'][::stride], data['lon'][::stride]
+        depth = data['depth'][::stride, ::stride]
+        dip = data['dip'][::stride, ::stride]
+        strike = data['strike'][::stride, ::stride]
+        dlat, dlon = lat[1] - lat[0], lon[1] - lon[0]
+        R = 6377905  # same as Custom.build_fault
+
+        x, y = dtopo_grid()
+        dx = x[1] - x[0]
+
+        inside = np.isfinite(depth) & (depth <= max_depth) & np.isfinite(dip) & np.isfinite(strike)
+        rows, cols = np.nonzero(inside)
+        lattice_node = -np.ones(depth.shape, dtype=int)
+        lattice_node[rows, cols] = np.arange(len(rows))
+
+        node_lat, node_lon = lat[rows], lon[cols]
+        # map view area of each lattice cell, covered by a square patch of side a
+        node_area = (R * np.radians(dlat)) * (R * np.radians(dlon) * np.cos(np.radians(node_lat)))
+        side = np.sqrt(node_area)
+
+        # lower left corner of each node's window in the dtopo grid
+        window = np.stack([np.rint((node_lat - y[0]) / dx).astype(int) - half_width,
+                           np.rint((node_lon - x[0]) / dx).astype(int) - half_width], axis=1)
+
+        n = 2*half_width + 1
+        fields = np.lib.format.open_memmap(path + '.npy.tmp', mode='w+', dtype=np.float32,
+                                           shape=(len(offsets), len(rows), n, n))
+        for k in range(len(rows)):
+            r, c = rows[k], cols[k]
+            wy = y[0] + dx * (window[k, 0] + np.arange(n))
+            wx = x[0] + dx * (window[k, 1] + np.arange(n))
+            for l, offset in enumerate(offsets):
+                subfault = dtopotools.SubFault()
+                subfault.strike = strike[r, c]
+                subfault.dip = dip[r, c]
+                subfault.rake = rake
+                subfault.length = side[k]
+                subfault.width = side[k] / np.cos(np.radians(dip[r, c]))
+                # keep the patch below the sea floor
+                subfault.depth = max(depth[r, c] + offset, 0.5 * subfault.width * np.sin(np.radians(dip[r, c])) + 100.)
+                subfault.slip = 1.
+                subfault.longitude = node_lon[k]
+                subfault.latitude = node_lat[k]
+                subfault.coordinate_specification = "centroid"
+                fault = dtopotools.Fault()
+                fault.subfaults = [subfault]
+                fault.create_dtopography(wx, wy, [1.])
+                fields[l, k] = fault.dtopo.dZ[-1]
+            if k % 100 == 0:
+                print("Unit sources:", k, "of", len(rows))
+        fields.flush()
+        del fields
+        os.rename(path + '.npy.tmp', path + '.npy')
+
+        np.savez(path + '.npz', node_lat=node_lat, node_lon=node_lon, node_depth=depth[rows, cols],
+                 node_area=node_area, window=window, offsets=np.array(offsets), lattice_lat=lat, lattice_lon=lon,
+                 lattice_node=lattice_node, x=x, y=y, rake=rake)
+
+    def node_weights(self, okada_params, n=8):
+        """
+        Slip weights of the lattice patches covered by a rupture
+        :param okada_params: pandas Series: okada parameters (see map_to_okada)
+        :param n: Int: each subfault is sampled with n x n points
+        :return: node indices, layer indices, weights for the layer and the next one
+        """
+        sub = subfault_arrays(okada_params)
+        lat, lon = rupture_points(okada_params, n, midpoints=True)
+        lat, lon = lat[0], lon[0]
+        K = sub['lat'].shape[1]
+        # map view area represented by each point
+        area = np.repeat(1.e6 * sub['length'][0] * sub['width'][0] * np.cos(np.radians(sub['dip'][0])) / n**2, n*n)
+
+        dlat = self.lattice_lat[1] - self.lattice_lat[0]
+        dlon = self.lattice_lon[1] - self.lattice_lon[0]
+        r = np.rint((lat - self.lattice_lat[0]) / dlat).astype(int)
+        c = np.rint((lon - self.lattice_lon[0]) / dlon).astype(int)
+        valid = (r >= 0) & (r < len(self.lattice_lat)) & (c >= 0) & (c < len(self.lattice_lon))
+        node = np.where(valid, self.lattice_node[np.clip(r, 0, len(self.lattice_lat)-1),
+                                                 np.clip(c, 0, len(self.lattice_lon)-1)], -1)
+        if np.any(node < 0):
+            print("WARNING: {:.1%} of the rupture is outside the unit source library".format(np.mean(node < 0)))
+
+        subfault = np.repeat(np.arange(K), n*n)
+        fault_depth = self.depth_map(np.stack([sub['lat'][0], sub['lon'][0]], axis=1))
+        offset = (1000. * sub['depth'][0] - fault_depth)[subfault]
+
+        # depth offset of each subfault from the fault, interpolated between the stored layers
+        keep = node >= 0
+        node, area, offset = node[keep], area[keep], offset[keep]
+        offset = np.clip(np.nan_to_num(offset), self.offsets[0], self.offsets[-1])
+        layer = np.clip(np.searchsorted(self.offsets, offset) - 1, 0, len(self.offsets) - 2)
+        frac = (offset - self.offsets[layer]) / (self.offsets[layer+1] - self.offsets[layer])
+
+        weight = area / self.node_area[node]
+        return node, layer, weight * (1 - frac), weight * frac
+
+    def deformation(self, okada_params):
+        """
+        Sea floor deformation of a uniform slip rupture on the dtopo grid
+        :param okada_params: pandas Series: okada parameters (see map_to_okada)
+        :return: (len(y), len(x)) array of vertical deformation (m)
+        """
+        if okada_params['Rake'] != self.rake:
+            raise ValueError("The unit source library was built for rake {}".format(self.rake))
+        node, layer, w0, w1 = self.node_weights(okada_params)
+
+        # accumulate the weights of each (node, layer) pair, then add each window once
+        key = np.concatenate([node * len(self.offsets) + layer, node * len(self.offsets) + layer + 1])
+        keys, inverse = np.unique(key, return_inverse=True)
+        weights = np.bincount(inverse, weights=np.concatenate([w0, w1]))
+
+        n = 2*self.half_width + 1
+        ny, nx = len(self.y), len(self.x)
+        dz = np.zeros((ny + 2*n, nx + 2*n))
+        for k, w in zip(keys, weights):
+            i, l = divmod(k, len(self.offsets))
+            r0, c0 = self.window[i] + n
+            dz[r0:r0+n, c0:c0+n] += w * self.fields[l, i]
+        return okada_params['Slip'] * dz[n:n+ny, n:n+nx]
+
+    def okada_error(self, okada_params, tol=1.e-3):
+        """
+        Error of deformation against the Okada deformation of the same rupture, on the footprint of the
+        Okada deformation (see maketopo.footprint_grid)
+        :param okada_params: pandas Series: okada parameters (see map_to_okada)
+        :param tol: float: deformation tolerance of the footprint (m)
+        :return: largest absolute error (m), largest absolute Okada deformation (m), relative L2 error
+        """
+        from maketopo import okada_fault, footprint_grid
+
+        fault = okada_fault(okada_params)
+        x, y = footprint_grid(fault, self.x, self.y, tol)
+        fault.create_dtopography(x, y, [1.])
+        okada = fault.dtopo.dZ[-1]
+
+        c0 = int(np.argmin(np.abs(self.x - x[0])))
+        r0 = int(np.argmin(np.abs(self.y - y[0])))
+        error = self.deformation(okada_params)[r0:r0+len(y), c0:c0+len(x)] - okada
+        return np.abs(error).max(), np.abs(okada).max(), np.linalg.norm(error) / np.linalg.norm(okada)
@@ -21,13 +21,16 @@ def abrahamson(mag, dist, V_S30):
     backarc (bool): True for backarc site
     tau (float): Interevent standard deviation
 
+    mag, dist and V_S30 may be arrays; they are broadcast against each other
+    so that many sites and samples can be evaluated in one call.
+
     Returns
     ----------
     (float): Spectral acceleration in units of g
     (float): Standard deviation of ln(PSA) in units of g
 
     """
-    def run_model(M, R, PGA, VS30):
+    def run_model(M, R, PGA, VS30, pga_coeffs=False):
 
         # Period-independent coefficients
         n = 1.18
@@ -36,7 +39,7 @@ def abrahamson(mag, dist, V_S30):
         backarc = False
 
         # coefficients for calulating PGA
-        if PGA == 0:
+        if pga_coeffs:
             V_lin = 865.1
             b = -1.186
             
@@ -61,27 +64,20 @@ def abrahamson(mag, dist, V_S30):
 
 
         # Magnitude scaling
-        if M > C1:
-            fmag = a[4]*(M-C1)+a[12]*(10-M)**2
-        else:
-            fmag = a[3]*(M-C1) + a[12]*(10-M)**2
+        fmag = np.where(M > C1, a[4]*(M-C1), a[3]*(M-C1)) + a[12]*(10-M)**2
 
 
         # Site response scaling
-        if VS30 > 1000: # Cap VS30 at 1000 m/s
-            Vstar = 1000.
-        else:
-            Vstar = VS30
+        Vstar = np.minimum(VS30, 1000.) # Cap VS30 at 1000 m/s
 
-        if VS30 < V_lin:
-            fsite = a[11]*np.log(Vstar/V_lin)-b*np.log(PGA+c) + \
-                    b*np.log(PGA + c*(Vstar/V_lin)**n)
-        else:
-            fsite = (a[11]+ b*n)*np.log(Vstar/V_lin)
+        fsite = np.where(VS30 < V_lin,
+                         a[11]*np.log(Vstar/V_lin)-b*np.log(PGA+c) +
+                         b*np.log(PGA + c*(Vstar/V_lin)**n),
+                         (a[11]+ b*n)*np.log(Vstar/V_lin))
 
         # Forearc vs Backarc
         if backarc:
-            fFABA = a[14]+a[15]*np.log(max(R,100)/40)
+            fFABA = a[14]+a[15]*np.log(np.maximum(R,100)/40)
         else:
             fFABA = 0
 
@@ -98,7 +94,7 @@ def abrahamson(mag, dist, V_S30):
 
 
     # Calculate PGA 1000
-    PGA_1000 = np.exp(run_model(mag, dist, 0, 1000.))
+    PGA_1000 = np.exp(run_model(mag, dist, 0, 1000., pga_coeffs=True))
     
     # Run model for period = 1hz
     log = run_model(mag, dist, PGA_1000, V_S30)
@@ -0,0 +1,116 @@
+"""
+Convergence diagnostics of the chains for the stopping rule of Scenario.run.
+
+The effective sample size and the split R-hat follow Gelman et al., Bayesian Data Analysis (3rd ed.), 11.4-11.5:
+each chain is split in two halves, so a single chain still gets an R-hat (comparing its halves), and the ESS
+of all the chains together uses the combined autocorrelations truncated by Geyer's initial monotone sequence.
+"""
+import glob
+import os
+import numpy as np
+import pandas as pd
+
+
+def split_chains(chains, discard=0.5):
+    """
+    Drops the first discard fraction of every chain as warm-up, truncates the chains to the same length and
+    splits each in two halves
+    :param chains: list of (n_i, d) arrays
+    :param discard: float: fraction of each chain dropped as warm-up
+    :return: (2m, n, d) array
+    """
+    n = min(len(chain) for chain in chains)
+    n = (n - int(discard * n)) // 2
+    halves = []
+    for chain in chains:
+        chain = np.asarray(chain, dtype=float)[len(chain) - 2 * n:]
+        halves += [chain[:n], chain[n:]]
+    return np.array(halves)
+
+
+def autocovariance(x):
+    """
+    Autocovariances of the rows of x for all lags, by FFT
+    :param x: (m, n) array
+    :return: (m, n) array
+    """
+    n = x.shape[1]
+    f = np.fft.rfft(x - x.mean(axis=1, keepdims=True), 2 * n, axis=1)
+    return np.fft.irfft(f * np.conj(f), axis=1)[:, :n] / n
+
+
+def split_rhat(halves):
+    """
+    Split R-hat of each parameter
+    :param halves: (2m, n, d) array from split_chains
+    :return: (d,) array (inf for a parameter that did not move)
+    """
+    n = halves.shape[1]
+    W = halves.var(axis=1, ddof=1).mean(axis=0)
+    B_n = halves.mean(axis=1).var(axis=0, ddof=1)
+    var_plus = (n - 1) / n * W + B_n
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(W > 0, np.sqrt(var_plus / W), np.inf)
+
+
+def ess(halves):
+    """
+    Effective sample size of each parameter, over all the chains
+    :param halves: (2m, n, d) array from split_chains
+    :return: (d,) array (0 for a parameter that did not move)
+    """
+    m, n, d = halves.shape
+    result = np.zeros(d)
+    for j in range(d):
+        x = halves[:, :, j]
+        W = x.var(axis=1, ddof=1).mean()
+        var_plus = (n - 1) / n * W + x.mean(axis=1).var(ddof=1)
+        if not W > 0:
+            continue
+        rho = 1. - (W - autocovariance(x).mean(axis=0)) / var_plus
+        # Geyer's initial monotone sequence of the sums of pairs of autocorrelations
+        tau, prev = -1., np.inf
+        for t in range(0, n - 1, 2):
+            pair = rho[t] + rho[t + 1]
+            if pair <= 0:
+                break
+            prev = min(prev, pair)
+            tau += 2 * prev
+        result[j] = m * n / tau
+    return result
+
+
+def load_chains(pattern, cols, exclude=None):
+    """
+    Reads the samples of the other chains from their chain stores (samples.csv). Files that cannot be read,
+    e.g. while their chain is writing them, are skipped.
+    :param pattern: String: glob pattern of the samples.csv files
+    :param cols: list of the sample parameters
+    :param exclude: String: file of this chain
+    :return: list of (n_i, d) arrays
+    """
+    chains = []
+    for fname in sorted(glob.glob(pattern)):
+        if exclude is not None and os.path.abspath(fname) == os.path.abspath(exclude):
+            continue
+        try:
+            chain = pd.read_csv(fname, index_col=0)[cols].dropna().to_numpy(dtype=float)
+        except (OSError, KeyError, ValueError, pd.errors.ParserError, pd.errors.EmptyDataError):
+            continue
+        if len(chain) > 0:
+            chains.append(chain)
+    return chains
+
+
+def summary(chains, cols, discard=0.5):
+    """
+    ESS and split R-hat of each parameter
+    :param chains: list of (n_i, d) arrays
+    :param cols: list of the sample parameters
+    :param discard: float: fraction of each chain dropped as warm-up
+    :return: pandas DataFrame indexed by parameter with columns ESS and R-hat, None if the chains are too short
+    """
+    halves = split_chains(chains, discard)
+    if halves.shape[1] < 4:
+        return None
+    return pd.DataFrame({'ESS': ess(halves), 'R-hat': split_rhat(halves)}, index=cols)
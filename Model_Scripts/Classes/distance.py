@@ -21,24 +21,23 @@ def convert_rectangular(lat, lon, depth=0):
     rectangular coordinates.
 
     Parameters:
-        lat (float): latitude in degrees
-        lon (float): longitude in degrees
-        depth (float): distance below the surface of the earth (km)
+        lat (float or ndarray): latitude in degrees
+        lon (float or ndarray): longitude in degrees
+        depth (float or ndarray): distance below the surface of the earth (km)
 
     Returns:
-        ((3,) ndarray): rectangular coordinates of points
+        ((...,3) ndarray): rectangular coordinates of points
     """
     R_earth = 6371 # radius of the earth in km
 
     #earthquake hypocenter coordinates (spherical, radians)
-    phi = np.radians(lon)
-    theta = np.radians(90-lat)
-    r = R_earth - depth
+    phi, theta = np.broadcast_arrays(np.radians(lon), np.radians(90-lat))
+    r = R_earth - np.asarray(depth)
 
-    # convert to rectangular
-    loc = r * np.array([np.sin(theta)*np.cos(phi),
-                        np.sin(theta)*np.sin(phi),
-                        np.cos(theta)])
+    # convert to rectangular (coordinates along the last axis for array input)
+    loc = r[..., None] * np.stack([np.sin(theta)*np.cos(phi),
+                                   np.sin(theta)*np.sin(phi),
+                                   np.cos(theta)], axis=-1)
 
     return loc
 
@@ -128,46 +127,101 @@ def distance(site_lat, site_lon, length, width, strike, dip, depth, lat, lon):
     ----------
     distance(float) - The shortest distance between site and earthquake
     """
-    #convert strike and dip to radians
-    strike_rad = np.radians(strike)
-    dip_rad = np.radians(dip)
-    
-    # convert site and hypocenter to rectangular coordinates
+    center, axes, half = fault_frames(length, width, strike, dip, depth, lat, lon)
     site = convert_rectangular(site_lat, site_lon)
-    hypocenter = convert_rectangular(lat, lon, depth)
-
-    # find length and width vectors for fault plane
-    len_vec, width_vec = fault_plane(hypocenter, lat, lon, length, width, strike_rad, dip_rad)
-
-    # change to a basis where the fault plane is a unit square on the x-y plane
-    # makes it easier to find closest point on fault plane to site
-    S = basis_change(len_vec, width_vec)
-    site_changed = S @ site
-    hypocenter_changed = S @ hypocenter
-
-    # find closest point on fault plane to site
-    closest_pt = hypocenter_changed
-
-    #changing site x coordinates to be within bounds
-    if site_changed[0] < hypocenter_changed[0] - 1:
-        closest_pt[0] -= 1
-    elif site_changed[0] > hypocenter_changed[0] + 1:
-        closest_pt[0] += 1
-    else:
-         closest_pt[0] = site_changed[0]
-
-    #changing site y coordinates to be within bounds
-    if site_changed[1] < hypocenter_changed[1] - 1:
-        closest_pt[1] -= 1
-    elif site_changed[1] > hypocenter_changed[1] + 1:
-        closest_pt[1] += 1
-    else:
-         closest_pt[1] = site_changed[1]
-
-    # reverse change of basis
-    closest_pt = la.inv(S) @ closest_pt
-
-    return np.linalg.norm(site - closest_pt)
+    return float(frame_distance(site, center, axes, half))
+
+def fault_frames(length, width, strike, dip, depth, lat, lon):
+    """Precomputes the orthonormal frame of each (Okada) rectangle, so that
+    distances to any number of sites can be found by projection and clamping
+    without a change of basis matrix.
+
+    The frame is the same rectangle as fault_plane(): the strike unit vector
+    is north rotated clockwise by strike in the local tangent plane, the dip
+    unit vector is horizontal and perpendicular to strike, tilted down by dip,
+    and the normal completes the right-handed system.
+
+    Parameters:
+    ----------
+    length(km), width(km) - Rectangle dimensions, scalars or arrays broadcasting with the others
+    strike(deg), dip(deg) - Rectangle orientation
+    depth(km) - Depth below sea level (positive) of the rectangle centroid
+    lat(deg), lon(deg) - Coordinates of the rectangle centroid
+
+    Returns:
+    ----------
+    center ((...,3) ndarray) - rectangular coordinates of the centroids
+    axes ((...,3,3) ndarray) - rows are the strike, dip and normal unit vectors
+    half ((...,2) ndarray) - half length and half width
+    """
+    strike_rad, dip_rad, phi, theta = np.broadcast_arrays(np.radians(strike), np.radians(dip),
+                                                          np.radians(lon), np.radians(90-lat))
+    zero = np.zeros_like(phi)
+
+    # local up, north and east unit vectors at the centroid
+    up = np.stack([np.sin(theta)*np.cos(phi), np.sin(theta)*np.sin(phi), np.cos(theta)], axis=-1)
+    north = np.stack([-np.cos(theta)*np.cos(phi), -np.cos(theta)*np.sin(phi), np.sin(theta)], axis=-1)
+    east = np.stack([-np.sin(phi), np.cos(phi), zero], axis=-1)
+
+    cos_s, sin_s = np.cos(strike_rad)[..., None], np.sin(strike_rad)[..., None]
+    cos_d, sin_d = np.cos(dip_rad)[..., None], np.sin(dip_rad)[..., None]
+    strike_vec = north*cos_s + east*sin_s
+    dip_vec = (east*cos_s - north*sin_s)*cos_d - up*sin_d
+    normal_vec = np.cross(strike_vec, dip_vec)
+
+    center = convert_rectangular(lat, lon, depth)
+    axes = np.stack((strike_vec, dip_vec, normal_vec), axis=-2)
+    half = np.stack(np.broadcast_arrays(np.asarray(length)/2, np.asarray(width)/2), axis=-1)
+
+    return center, axes, half
+
+def frame_distance(site, center, axes, half):
+    """Computes the shortest distance between sites and rectangles given by
+    fault_frames(). The site offset is projected onto the rectangle axes, the
+    in-plane coordinates are clamped to the rectangle, and what remains is the
+    distance.
+
+    Parameters:
+    ----------
+    site ((...,3) ndarray) - rectangular coordinates of the sites
+    center, axes, half - output of fault_frames(), broadcasting with site
+
+    Returns:
+    ----------
+    (ndarray) - distances, with the broadcast shape of site and center minus the coordinate axis
+    """
+    offset = site - center
+    proj = np.einsum('...ij,...j->...i', axes, offset)
+    excess = proj[..., :2] - np.clip(proj[..., :2], -half, half)
+    return np.sqrt(proj[..., 2]**2 + np.sum(excess**2, axis=-1))
+
+def rupture_distance(site_lat, site_lon, length, width, strike, dip, depth, lat, lon):
+    """Computes the shortest distance between many sites and many (Okada)
+    rectangles at once. Same geometry as distance(), vectorized over sites,
+    subfaults and samples.
+
+    Parameters:
+    ----------
+    site_lat, site_lon ((M,) ndarray) - Site coordinates (degrees)
+    length, width ((N,) or (N,K) ndarray) - Subfault dimensions (km)
+    strike, dip ((N,K) ndarray) - Subfault orientation (degrees)
+    depth ((N,K) ndarray) - Depth of the subfault centroids (km)
+    lat, lon ((N,K) ndarray) - Subfault centroid coordinates (degrees)
+
+    Returns:
+    ----------
+    ((N,K,M) ndarray) - distance from each site to each subfault of each sample (km)
+    """
+    strike, dip, depth, lat, lon = [np.atleast_2d(arr) for arr in (strike, dip, depth, lat, lon)]
+    length, width = [np.asarray(arr, dtype=float) for arr in (length, width)]
+    if length.ndim < 2:
+        length, width = length.reshape(-1, 1), width.reshape(-1, 1)
+
+    # frames depend only on the subfaults; sites get broadcast over (N,K)
+    center, axes, half = fault_frames(length, width, strike, dip, depth, lat, lon)
+    site = convert_rectangular(np.asarray(site_lat), np.asarray(site_lon))
+
+    return frame_distance(site, center[..., None, :], axes[..., None, :, :], half[..., None, :])
 
 '''
 # convex optimization solution
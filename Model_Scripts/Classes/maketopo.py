@@ -43,14 +43,80 @@ def get_topo(makeplots=False):
 
 
 
-def make_dtopo(params, makeplots=False):
+def dtopo_grid():
     """
-    Create dtopo data file for deformation of sea floor due to earthquake.
-    Uses the Okada model with fault parameters and mesh specified below.
+    Grid of the dtopo file: 1 minute resolution over the model bounds
+    :return: x, y arrays of longitudes and latitudes
+    """
+    with open('./PreRun/InputData/model_bounds.txt') as json_file:
+        model_bounds = json.load(json_file)
+
+    xlower = model_bounds['xlower']
+    xupper = model_bounds['xupper']
+    ylower = model_bounds['ylower']
+    yupper = model_bounds['yupper']
+
+    # dtopo parameters
+
+    points_per_degree = 60 # 1 minute resolution
+    dx = 1./points_per_degree
+    mx = int((xupper - xlower)/dx + 1)
+    xupper = xlower + (mx-1)*dx
+    my = int((yupper - ylower)/dx + 1)
+    yupper = ylower + (my-1)*dx
+    print("New upper bounds:\n")
+    print("latitude:",yupper)
+    print("longitude:",xupper)
+    x = np.linspace(xlower, xupper, mx)
+    y = np.linspace(ylower, yupper, my)
+    return x, y
+
+
+def footprint(dz, tol, margin=0):
+    """
+    Smallest block of a deformation grid outside which the deformation is below a tolerance
+    :param dz: (ny, nx) array of vertical deformation (m)
+    :param tol: float: deformation tolerance (m)
+    :param margin: Int: grid cells added on each side
+    :return: row slice, column slice, or None if the deformation is below tol everywhere
     """
+    above = np.abs(dz) > tol
+    rows = np.nonzero(above.any(axis=1))[0]
+    cols = np.nonzero(above.any(axis=0))[0]
+    if len(rows) == 0:
+        return None
+    return (slice(max(rows[0] - margin, 0), min(rows[-1] + margin + 1, dz.shape[0])),
+            slice(max(cols[0] - margin, 0), min(cols[-1] + margin + 1, dz.shape[1])))
 
-    dtopo_fname = os.path.join('./InputData/', "dtopo.tt3")
 
+def footprint_grid(fault, x, y, tol, coarsen=10):
+    """
+    Crops the dtopo grid to the footprint of a fault's deformation. Okada is first evaluated on every
+    coarsen-th point of the grid, then the grid is cropped to the coarse points where the deformation
+    exceeds tol, plus two coarse cells since the deformation between coarse points is not known.
+    :param fault: dtopotools.Fault
+    :param x, y: arrays of longitudes and latitudes of the dtopo grid
+    :param tol: float: deformation tolerance (m)
+    :param coarsen: Int: grid points per coarse cell
+    :return: cropped x, y arrays
+    """
+    fault.create_dtopography(x[::coarsen], y[::coarsen], [1.])
+    box = footprint(fault.dtopo.dZ[-1], tol, margin=2)
+    if box is None:
+        return x, y
+    rows, cols = box
+    # a block reaching the last coarse point also keeps the grid points past it
+    xstop = len(x) if cols.stop == len(x[::coarsen]) else (cols.stop - 1)*coarsen + 1
+    ystop = len(y) if rows.stop == len(y[::coarsen]) else (rows.stop - 1)*coarsen + 1
+    return x[cols.start*coarsen:xstop], y[rows.start*coarsen:ystop]
+
+
+def okada_fault(params):
+    """
+    Okada fault model of the rectangles of a sample
+    :param params: pandas Series: okada parameters (see map_to_okada)
+    :return: dtopotools.Fault
+    """
     # number of cols = number of rectangles * number of changing params + number of constant params
     n = (len(params) - 4) // 5
 
@@ -74,6 +140,40 @@ def make_dtopo(params, makeplots=False):
 
     fault = dtopotools.Fault()
     fault.subfaults = subfaults
+    return fault
+
+
+def make_dtopo(params, makeplots=False, unit_sources=None, tol=1.e-3):
+    """
+    Create dtopo data file for deformation of sea floor due to earthquake.
+    Uses the Okada model with fault parameters and mesh specified below,
+    or sums the deformations of the unit source library if one is given.
+
+    The dtopo file only covers the deformation footprint, where the deformation exceeds tol:
+    GeoClaw leaves the topography unchanged outside of it. The file values are written
+    with 3 decimals, so the default 1 mm drops nothing the full grid would resolve.
+    :param tol: float: deformation tolerance (m), None to write the full grid
+    """
+
+    dtopo_fname = os.path.join('./InputData/', "dtopo.tt3")
+
+    if unit_sources is not None and not os.path.exists(dtopo_fname):
+        print("Using the unit source library to create dtopo file")
+        dtopo = dtopotools.DTopography()
+        dz = unit_sources.deformation(params)
+        x, y = unit_sources.x, unit_sources.y
+        box = footprint(dz, tol, margin=1) if tol is not None else None
+        if box is not None:
+            rows, cols = box
+            x, y, dz = x[cols], y[rows], dz[rows, cols]
+        dtopo.x, dtopo.y = x, y
+        dtopo.X, dtopo.Y = np.meshgrid(dtopo.x, dtopo.y)
+        dtopo.times = [1.]
+        dtopo.dZ = dz[np.newaxis]
+        dtopo.write(dtopo_fname, dtopo_type=3)
+        return
+
+    fault = okada_fault(params)
     print(fault.subfaults)
 
     print("Mw = ",fault.Mw())
@@ -89,27 +189,11 @@ def make_dtopo(params, makeplots=False):
         #y = numpy.linspace(-40, -30, 100)
         times = [1.]
 
-        with open('./PreRun/InputData/model_bounds.txt') as json_file:
-            model_bounds = json.load(json_file)
-
-        xlower = model_bounds['xlower']
-        xupper = model_bounds['xupper']
-        ylower = model_bounds['ylower']
-        yupper = model_bounds['yupper']
-
-        # dtopo parameters
-
-        points_per_degree = 60 # 1 minute resolution
-        dx = 1./points_per_degree
-        mx = int((xupper - xlower)/dx + 1)
-        xupper = xlower + (mx-1)*dx
-        my = int((yupper - ylower)/dx + 1)
-        yupper = ylower + (my-1)*dx
-        print("New upper bounds:\n")
-        print("latitude:",yupper)
-        print("longitude:",xupper)
-        x = np.linspace(xlower, xupper, mx)
-        y = np.linspace(ylower, yupper, my)
+        x, y = dtopo_grid()
+        if tol is not None:
+            size = len(x) * len(y)
+            x, y = footprint_grid(fault, x, y, tol)
+            print("Deformation footprint: {} of {} dtopo grid points".format(len(x) * len(y), size))
 
         fault.create_dtopography(x,y,times,verbose=True)
         dtopo = fault.dtopo
@@ -11,6 +11,7 @@ from __future__ import print_function
 import os
 import numpy as np
 import json
+from topo_cache import topo_file
 
 try:
     CLAW = os.environ['CLAW']
@@ -21,6 +22,55 @@ except:
 scratch_dir = os.path.join(CLAW, 'geoclaw', 'scratch')
 
 
+#------------------------------
+def amr_max_level(model_bounds):
+#------------------------------
+    """
+    Finest AMR level of the run: the full hierarchy given by model_bounds['AMR_levels'],
+    truncated to $AMR_MAX_LEVEL when that is set (coarse runs of the multilevel MCMC).
+    """
+    maxlevel = len(model_bounds['AMR_levels'])+1
+    if os.environ.get('AMR_MAX_LEVEL'):
+        maxlevel = min(maxlevel, int(os.environ['AMR_MAX_LEVEL']))
+    return maxlevel
+
+
+#------------------------------
+def output_profile():
+#------------------------------
+    """
+    Output profile of the run, set by $OUTPUT_PROFILE:
+      "mcmc"  (default) - no initial frame, final frame only in binary, no time step reports on screen.
+                          FeedForward only reads the fgmax output, which is unaffected.
+    Both profiles report the time steps of each level in fort.amr, which telemetry.py reads.
+      "debug"           - ascii frames including t0 and time step reports on level 1
+    """
+    profile = os.environ.get('OUTPUT_PROFILE', 'mcmc')
+    if profile not in ('mcmc', 'debug'):
+        raise ValueError("Unknown OUTPUT_PROFILE: " + profile + " (expected mcmc or debug)")
+    return profile
+
+
+#------------------------------
+def fgmax_file(maxlevel, fname='./PreRun/InputData/fgmax_grid.txt'):
+#------------------------------
+    """
+    fgmax points are only monitored on levels >= min_level_check (4th line of the fgmax file).
+    If the run is truncated below that level, write and return a copy of the fgmax file
+    with min_level_check lowered to maxlevel.
+    """
+    with open(fname) as f:
+        lines = f.readlines()
+    if int(lines[3].split()[0]) <= maxlevel:
+        return fname
+
+    lines[3] = '%-28i# min_level_check\n' % maxlevel
+    coarse_fname = fname.replace('.txt', '_level%i.txt' % maxlevel)
+    with open(coarse_fname, 'w') as f:
+        f.writelines(lines)
+    return coarse_fname
+
+
 #------------------------------
 def setrun(claw_pkg='geoclaw'):
 #------------------------------
@@ -134,7 +184,7 @@ def setrun(claw_pkg='geoclaw'):
         # Output nout frames at equally spaced times up to tfinal:
         clawdata.num_output_times = 1 #JPW: change this back to 1 or 2
         clawdata.tfinal = model_bounds['run_time'] * 60.
-        clawdata.output_t0 = True  # output at initial (or restart) time?
+        clawdata.output_t0 = (output_profile() == 'debug')  # output at initial (or restart) time?
 
     elif clawdata.output_style == 2:
         # Specify a list of output times.
@@ -147,9 +197,13 @@ def setrun(claw_pkg='geoclaw'):
         clawdata.output_t0 = True
 
 
-    clawdata.output_format = 'ascii'      # 'ascii' or 'netcdf'
-
-    clawdata.output_q_components = 'all'   # need all
+    if output_profile() == 'debug':
+        clawdata.output_format = 'ascii'      # 'ascii' or 'netcdf'
+        clawdata.output_q_components = 'all'   # need all
+    else:
+        # the final frame only marks the end of the run, the likelihood uses fgmax
+        clawdata.output_format = 'binary'
+        clawdata.output_q_components = 'none'
     clawdata.output_aux_components = 'none'  # eta=h+B is in q
     clawdata.output_aux_onlyonce = False    # output aux arrays each frame
 
@@ -162,7 +216,7 @@ def setrun(claw_pkg='geoclaw'):
     # The current t, dt, and cfl will be printed every time step
     # at AMR levels <= verbosity.  Set verbosity = 0 for no printing.
     #   (E.g. verbosity == 2 means print only on levels 1 and 2.)
-    clawdata.verbosity = 1
+    clawdata.verbosity = 1 if output_profile() == 'debug' else 0
 
 
 
@@ -284,7 +338,7 @@ def setrun(claw_pkg='geoclaw'):
     amrdata = rundata.amrdata
 
     # max number of refinement levels:
-    amrdata.amr_levels_max = len(model_bounds['AMR_levels'])+1  #JW: I'm not sure if this is going to work...check this :)
+    amrdata.amr_levels_max = amr_max_level(model_bounds)  #JW: I'm not sure if this is going to work...check this :)
 
     # List of refinement ratios at each level (length at least mxnest-1)
     amrdata.refinement_ratios_x = model_bounds['AMR_levels']
@@ -331,7 +385,7 @@ def setrun(claw_pkg='geoclaw'):
     amrdata.pprint = False      # proj. of tagged points
     amrdata.rprint = False      # print regridding summary
     amrdata.sprint = False      # space/memory output
-    amrdata.tprint = True       # time step reporting each level
+    amrdata.tprint = True       # time step reporting each level (to fort.amr, read by telemetry.py)
     amrdata.uprint = False      # update/upbnd reporting
 
     # More AMR parameters can be set -- see the defaults in pyclaw/data.py
@@ -342,10 +396,14 @@ def setrun(claw_pkg='geoclaw'):
     rundata.regiondata.regions = []
     # to specify regions of refinement append lines of the form
     #  [minlevel,maxlevel,t1,t2,x1,x2,y1,y2]
-    maxlevel = len(model_bounds["AMR_levels"])+1
+    maxlevel = amr_max_level(model_bounds)
     print("this is maxlevel")
     print(maxlevel)#JPW: remove this...debug only
     regions_bounds = model_bounds["regions_bounds"]
+    # time windows from the travel time estimate of the current rupture, see FeedForward.write_region_times
+    if os.path.isfile('./InputData/region_times.json'):
+        with open('./InputData/region_times.json') as json_file:
+            regions_bounds = json.load(json_file)
     for i in range(len(regions_bounds)):
         rundata.regiondata.regions.append([maxlevel,maxlevel]+regions_bounds[i])
  
@@ -355,6 +413,12 @@ def setrun(claw_pkg='geoclaw'):
     # ---------------
     # Gauges:
     # ---------------
+    # gauges of the Green's function campaign, see GreensFunctions.run_campaign
+    if os.environ.get('GAUGES_FILE'):
+        with open(os.environ['GAUGES_FILE']) as json_file:
+            for gaugeno, x, y in json.load(json_file):
+                rundata.gaugedata.gauges.append([gaugeno, x, y, 0., 1.e10])
+
     # rundata.gaugedata.gauges = []
     # # for gauges append lines of the form  [gaugeno, x, y, t1, t2]
     # with open('gauges.txt') as json_file:
@@ -370,7 +434,7 @@ def setrun(claw_pkg='geoclaw'):
     # == fgmax.data values ==
     fgmax_files = rundata.fgmax_data.fgmax_files
     # for fixed grids append to this list names of any fgmax input files
-    fgmax_files.append('./PreRun/InputData/fgmax_grid.txt')
+    fgmax_files.append(fgmax_file(amr_max_level(model_bounds)))
     rundata.fgmax_data.num_fgmax_val = 1  # Save depth only
 
     #------------------------------------------------------------------                                                                         
@@ -382,8 +446,10 @@ def setrun(claw_pkg='geoclaw'):
     adjointdata.use_adjoint = True
 
     # location of adjoint solution, must first be created:                                                                                      
+    # (Adjoint.run_geo_claw sets ADJOINT_OUTDIR to the cached solution)
 #    adjointdata.adjoint_outdir = os.path.abspath('./InputData/adjoint/_output')
-    adjointdata.adjoint_outdir = '/fslgroup/fslg_tsunami/compute/runs/34904110_m8/InputData/adjoint/_output'
+    adjointdata.adjoint_outdir = os.environ.get('ADJOINT_OUTDIR',
+        '/fslgroup/fslg_tsunami/compute/runs/34904110_m8/InputData/adjoint/_output')
 #    adjointdata.adjoint_outdir = '/fslgroup/fslg_tsunami/compute/runs/1852jgr_2019-09-03_12.57.53/InputData/adjoint/_output'
     #adjointdata.adjoint_outdir = '/fslhome/sgiddens/fsl_groups/fslg_tsunami/compute/runs/33053989_m8/InputData/adjoint/_output'
 
@@ -449,19 +515,21 @@ def setgeo(rundata):
         print("printing model_bounds")
         print(model_bounds)
         gauge_topo = model_bounds["gauge_topo"]
-    maxlevel = len(model_bounds['AMR_levels'])+1
+    maxlevel = amr_max_level(model_bounds)
 
 
     # == settopo.data values ==
     topo_data = rundata.topo_data
     # for topography, append lines of the form
     #    [topotype, minlevel, maxlevel, t1, t2, fname]
-    topo_path = os.path.join('./InputData/', 'etopo.tt3')
-    topo_data.topofiles.append([3, 1, maxlevel, 0., 1.e10, topo_path])
+    # (topo_type 4 when Main.py staged netCDF copies of the topography, coarsened copies
+    # from the topography pyramid when the run is truncated at a coarse AMR level)
+    topo_type, topo_path = topo_file('etopo.tt3', maxlevel)
+    topo_data.topofiles.append([topo_type, 1, maxlevel, 0., 1.e10, topo_path])
 
     for i in range(len(gauge_topo)):
-        topo_path = os.path.join('./InputData/', gauge_topo[i])
-        topo_data.topofiles.append([3, 1, maxlevel, 0., 1.e10, topo_path])
+        topo_type, topo_path = topo_file(gauge_topo[i], maxlevel)
+        topo_data.topofiles.append([topo_type, 1, maxlevel, 0., 1.e10, topo_path])
 
 #    topo_path = os.path.join('./InputData/', 'banda_map_merged.tt3')
 #    topo_data.topofiles.append([3, 1, 3, 0., 1.e10, topo_path])
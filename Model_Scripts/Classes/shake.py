@@ -0,0 +1,62 @@
+"""
+Vectorized shake (MMI) forward model.
+
+Evaluates Abrahamson spectral acceleration and the Atkinson-Kaka MMI conversion
+for every site, subfault and sample in one call instead of looping over gauges.
+"""
+import numpy as np
+import pandas as pd
+
+from abrahamson import abrahamson
+from distance import rupture_distance
+from atkinson_kaka import convert_to_MMI
+
+
+def subfault_arrays(okada_params):
+    """
+    Extracts the subfault geometry from okada parameters in the format produced by map_to_okada
+    :param okada_params: pandas Series (one sample) or DataFrame (one sample per row)
+    :return: dict of (N,K) arrays lat, lon, strike, dip, depth (km) and (N,) arrays length, width (km)
+    """
+    if isinstance(okada_params, pd.Series):
+        okada_params = okada_params.to_frame().T
+    n = (okada_params.shape[1] - 4) // 5
+
+    def cols(name):
+        return okada_params[[name + str(i+1) for i in range(n)]].to_numpy(dtype=float)
+
+    return {'lat': cols('Latitude'),
+            'lon': cols('Longitude'),
+            'strike': cols('Strike'),
+            'dip': cols('Dip'),
+            'depth': cols('Depth') / 1000.,
+            'length': okada_params['Sublength'].to_numpy(dtype=float) / 1000.,
+            'width': okada_params['Subwidth'].to_numpy(dtype=float) / 1000.}
+
+
+def shake_model(site_lat, site_lon, vs30, mag, lat, lon, strike, dip, depth, length, width):
+    """Computes the mean and standard deviation of MMI at M sites for N
+    samples of a K subfault rupture.
+
+    Parameters:
+    ----------
+    site_lat, site_lon ((M,) ndarray) - Site coordinates (degrees)
+    vs30 ((M,) ndarray) - Shear wave velocity in the top 30 meters at each site (m/s)
+    mag ((N,) ndarray) - Moment magnitude of each sample
+    lat, lon, strike, dip, depth ((N,K) ndarray) - Subfault centroids and orientation (degrees, km)
+    length, width ((N,) ndarray) - Subfault dimensions (km)
+
+    Returns:
+    ----------
+    mu_MMI ((N,M) ndarray) - mean MMI at each site for each sample
+    sigma ((N,M) ndarray) - standard deviation of MMI
+    """
+    # rupture distance is the distance to the closest subfault
+    D = rupture_distance(site_lat, site_lon, length, width, strike, dip, depth, lat, lon).min(axis=1)
+
+    mag = np.reshape(mag, (-1, 1))
+    logSA_g = abrahamson(mag, D, np.asarray(vs30, dtype=float))[0]
+    logSA = np.log(980.665) + logSA_g
+    mu_MMI, sigma = convert_to_MMI(logSA, mag, D)
+
+    return mu_MMI, np.broadcast_to(sigma, mu_MMI.shape)
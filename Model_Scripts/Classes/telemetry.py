@@ -0,0 +1,163 @@
+"""
+Cost telemetry of the GeoClaw runs.
+
+After each run, the time step reports (amrdata.tprint) and the end of run statistics that GeoClaw
+writes to fort.amr are parsed into the number of time steps, cells advanced and average number of
+grids on each AMR level. Together with the wall time and a few summary features of the rupture
+they are appended as one JSON line to a per-chain database (ModelOutput/telemetry.jsonl), so the
+cost of the forward model can be related to the region of parameter space a proposal is in.
+
+The database also trains a runtime model, a least squares fit of the log wall time on the rupture
+features, which FeedForward uses to stop runs that take far longer than predicted.
+"""
+import re
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+try:
+    from pandas import json_normalize
+except ImportError:  # pandas < 1.0
+    from pandas.io.json import json_normalize
+
+from shake import subfault_arrays
+
+# fort.amr line formats, see amr2.f90 and tick.f
+STEP = re.compile(r'AMRCLAW: level\s+(\d+)\s+CFL\s*=\s*(\S+)\s+dt\s*=\s*(\S+)\s+final t\s*=\s*(\S+)')
+GRIDS = re.compile(r'for level\s+(\d+)\s+average num. grids\s*=\s*(\S+)')
+CELLS = re.compile(r'# cells advanced on level\s+(\d+)\s*=\s*(\S+)')
+COURANT = re.compile(r'maximum Courant number seen\s*=\s*(\S+)')
+END = 'end of AMRCLAW integration'
+
+MU = 4.e10  # rigidity (Pa), same as the dtopotools default
+
+# rupture features of the runtime model
+FEATURES = ['mw', 'slip', 'length', 'width', 'depth', 'min_depth', 'dip']
+
+
+def parse_amr(path='fort.amr'):
+    """
+    Reads the time step reports and the run statistics of a GeoClaw run
+    :param path: String: fort.amr file of the run
+    :return: dict with steps, cells and grids (dicts level -> value), final_t (s), cfl_max and
+             complete (False if the run stopped before the end of the integration)
+    """
+    stats = {'steps': {}, 'cells': {}, 'grids': {}, 'final_t': 0., 'cfl_max': np.nan, 'complete': False}
+    try:
+        f = open(path)
+    except OSError:
+        return stats
+    with f:
+        for line in f:
+            match = STEP.search(line)
+            if match:
+                level = int(match.group(1))
+                stats['steps'][level] = stats['steps'].get(level, 0) + 1
+                if level == 1:
+                    stats['final_t'] = float(match.group(4))
+                continue
+            match = CELLS.search(line) or GRIDS.search(line)
+            if match:
+                key = 'cells' if match.re is CELLS else 'grids'
+                stats[key][int(match.group(1))] = float(match.group(2))
+                continue
+            match = COURANT.search(line)
+            if match:
+                stats['cfl_max'] = float(match.group(1))
+            elif END in line:
+                stats['complete'] = True
+    return stats
+
+
+def features(okada_params):
+    """
+    Summary of a rupture for the cost database, with a key identifying the exact okada parameters
+    :param okada_params: pandas Series: okada parameters (see map_to_okada)
+    :return: dict
+    """
+    sub = subfault_arrays(okada_params)
+    K = sub['lat'].shape[1]
+    moment = MU * okada_params['Slip'] * 1.e6 * sub['length'][0] * sub['width'][0] * K
+    values = okada_params.to_numpy(dtype=float)
+    return {'key': hashlib.sha1(values.tobytes()).hexdigest()[:16],
+            'mw': float(2./3. * (np.log10(moment) - 9.05)),
+            'slip': float(okada_params['Slip']),
+            'length': float(sub['length'][0]),
+            'width': float(sub['width'][0]),
+            'lat': float(sub['lat'].mean()),
+            'lon': float(sub['lon'].mean()),
+            'depth': float(sub['depth'].mean()),
+            'min_depth': float(sub['depth'].min()),
+            'dip': float(sub['dip'].mean())}
+
+
+def record(okada_params, wall_time, amr_max_level=None, status=0, timed_out=False, stopped_early=False,
+           fname='./ModelOutput/telemetry.jsonl', amr_file='fort.amr'):
+    """
+    Appends the telemetry of the last GeoClaw run to the database
+    :param okada_params: pandas Series: okada parameters of the run
+    :param wall_time: float: wall time of the run (s)
+    :param amr_max_level: int: finest AMR level of the run, None for the full hierarchy
+    :param status: int: exit status of the run
+    :param timed_out: Boolean: the run was stopped by the watchdog
+    :param stopped_early: Boolean: the run was stopped once the fgmax points had settled
+    :return: dict: the recorded entry
+    """
+    entry = features(okada_params)
+    entry.update(parse_amr(amr_file))
+    entry.update({'wall_time': float(wall_time), 'amr_max_level': amr_max_level, 'status': int(status),
+                  'timed_out': bool(timed_out), 'stopped_early': bool(stopped_early)})
+    with open(fname, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+    return entry
+
+
+def load(fname='./ModelOutput/telemetry.jsonl'):
+    """
+    Reads a telemetry database
+    :return: pandas DataFrame with one row per run, per level columns named e.g. steps.1, cells.3
+    """
+    with open(fname) as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    return json_normalize(entries)
+
+
+def fit_runtime(table, amr_max_level=None, min_runs=20):
+    """
+    Fits log(wall time) = c0 + sum_j c_j x_j on the standardized rupture features of the completed runs
+    (not the runs stopped once the fgmax points had settled, whose wall times are cut short)
+    :param table: pandas DataFrame from load
+    :param amr_max_level: int: only use runs at this finest AMR level (None for the full hierarchy)
+    :param min_runs: Int: fewer completed runs give no model
+    :return: dict with the mean and std of the features, the coefficients and the residual std, or None
+    """
+    if amr_max_level is None:
+        same_level = table['amr_max_level'].isna()
+    else:
+        same_level = table['amr_max_level'] == amr_max_level
+    done = (table['status'] == 0) & table['complete'].astype(bool)
+    if 'stopped_early' in table:
+        done &= ~table['stopped_early'].fillna(False).astype(bool)
+    runs = table[same_level & done]
+    if len(runs) < min_runs:
+        return None
+
+    X = runs[FEATURES].to_numpy(dtype=float)
+    mean, std = X.mean(axis=0), X.std(axis=0)
+    std[std == 0] = 1.
+    A = np.column_stack([np.ones(len(runs)), (X - mean) / std])
+    y = np.log(runs['wall_time'].to_numpy(dtype=float))
+    coef = np.linalg.lstsq(A, y, rcond=None)[0]
+    return {'mean': mean, 'std': std, 'coef': coef, 'sigma': float(np.std(y - A @ coef))}
+
+
+def predict_runtime(model, okada_params):
+    """
+    Predicted wall time of a run (s), see fit_runtime
+    :param model: dict from fit_runtime
+    :param okada_params: pandas Series: okada parameters
+    :return: float: median predicted wall time
+    """
+    entry = features(okada_params)
+    x = (np.array([entry[k] for k in FEATURES]) - model['mean']) / model['std']
+    return float(np.exp(model['coef'][0] + x @ model['coef'][1:]))
@@ -0,0 +1,326 @@
+"""
+Node-local staging of the topography files.
+
+Every GeoClaw run reads etopo.tt3 and the gauge topography files. Instead of copying them
+into each run directory, they are placed once per node in a cache (tmpfs if available),
+named by a fingerprint of their contents, and the run directories link to the cached copies.
+Where supported, each file is also converted once to netCDF (GeoClaw topo_type 4), which GeoClaw reads
+much faster than the ASCII topo_type 3 files. This needs the netCDF Fortran library to build GeoClaw with
+NETCDF=True (see Main.py) and netCDF4 for the conversion; without them the runs use the ASCII files.
+TOPO_NETCDF=1 requires the netCDF files (staging fails without support), TOPO_NETCDF=0 turns them off.
+
+Given the model bounds, each file is also cropped to the computational domain and a pyramid of
+coarsened copies is built, one per AMR level whose cell size is at least twice the file's resolution.
+Runs truncated at a coarse AMR level (the coarse runs of the multilevel MCMC) then read the copy
+matching their finest level instead of the full resolution nearshore grids.
+"""
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+import tempfile
+import warnings
+import numpy as np
+
+
+def cache_dir():
+    """
+    Default topography cache: $TOPO_CACHE, or topo_cache in the node-local $TMPFS (or the system temp directory)
+    :return: String: path of the cache directory
+    """
+    return os.environ.get('TOPO_CACHE',
+                          os.path.join(os.environ.get('TMPFS', tempfile.gettempdir()), 'topo_cache'))
+
+
+def fingerprint(path):
+    """
+    Hashes the contents of a file
+    :param path: String: file to hash
+    :return: String: hex digest identifying the file
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()[:16]
+
+
+def read_tt3(path):
+    """
+    Reads a topo_type 3 file
+    :param path: String: tt3 file
+    :return: xlower, ylower, cellsize, nodata_value, (nrows, ncols) array of values with the first row northmost
+    """
+    with open(path) as f:
+        header = [float(next(f).split()[0]) for _ in range(6)]
+    ncols, nrows, xlower, ylower, dx, nodata = header
+    Z = np.loadtxt(path, skiprows=6).reshape(int(nrows), int(ncols))
+    return xlower, ylower, dx, nodata, Z
+
+
+def write_tt3(path, xlower, ylower, dx, nodata, Z):
+    """Writes a topo_type 3 file, see read_tt3"""
+    nrows, ncols = Z.shape
+    header = '%i ncols\n%i nrows\n%.15e xlower\n%.15e ylower\n%.15e cellsize\n%.15g nodata_value' \
+             % (ncols, nrows, xlower, ylower, dx, nodata)
+    np.savetxt(path, Z, fmt='%.10g', header=header, comments='')
+
+
+def crop(xlower, ylower, dx, Z, bounds):
+    """
+    Crops topography to the smallest grid covering bounds
+    :param bounds: (x0, x1, y0, y1)
+    :return: xlower, ylower, cropped array, or None if the topography does not overlap bounds
+    """
+    x0, x1, y0, y1 = bounds
+    nrows, ncols = Z.shape
+    c0 = max(int(np.floor((x0 - xlower) / dx)), 0)
+    c1 = min(int(np.ceil((x1 - xlower) / dx)), ncols - 1)
+    r0 = max(int(np.floor((y0 - ylower) / dx)), 0)
+    r1 = min(int(np.ceil((y1 - ylower) / dx)), nrows - 1)
+    if c0 > c1 or r0 > r1:
+        return None
+    return xlower + c0*dx, ylower + r0*dx, Z[nrows-1-r1:nrows-r0, c0:c1+1]
+
+
+def coarsen(xlower, ylower, dx, nodata, Z, factor):
+    """
+    Averages factor x factor blocks of topography, ignoring missing values. Rows and columns
+    that do not fill a whole block are dropped on the north and east edges.
+    :return: xlower, ylower, cellsize and array of the coarsened topography, or None if it is smaller than one block
+    """
+    ny, nx = Z.shape[0] // factor, Z.shape[1] // factor
+    if ny == 0 or nx == 0:
+        return None
+    blocks = Z[Z.shape[0] - ny*factor:, :nx*factor]
+    blocks = np.where(blocks == nodata, np.nan, blocks).reshape(ny, factor, nx, factor)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        Zc = np.nanmean(blocks, axis=(1, 3))
+    Zc[np.isnan(Zc)] = nodata
+    shift = (factor - 1) / 2 * dx
+    return xlower + shift, ylower + shift, factor*dx, Zc
+
+
+def level_cellsizes(model_bounds):
+    """
+    Cell size of each AMR level
+    :param model_bounds: dict: model bounds (xlower, xupper, xcoarse_grid and AMR_levels are used)
+    :return: dict level -> cell size in degrees
+    """
+    dx = (model_bounds['xupper'] - model_bounds['xlower']) / model_bounds['xcoarse_grid']
+    sizes = {1: dx}
+    for level, ratio in enumerate(model_bounds['AMR_levels'], start=2):
+        dx = dx / ratio
+        sizes[level] = dx
+    return sizes
+
+
+def make_variants(path, base, model_bounds):
+    """
+    Writes the copy of a topography file cropped to the domain (base.tt3) and its coarsened
+    pyramid (base_L<level>.tt3)
+    :param path: String: source tt3 file
+    :param base: String: cached file path without extension
+    :param model_bounds: dict: model bounds
+    :return: list of levels with a pyramid file
+    """
+    xlower, ylower, dx, nodata, Z = read_tt3(path)
+
+    # keep one coarse cell around the domain so boundary and ghost cells are still covered
+    margin = level_cellsizes(model_bounds)[1]
+    bounds = (model_bounds['xlower'] - margin, model_bounds['xupper'] + margin,
+              model_bounds['ylower'] - margin, model_bounds['yupper'] + margin)
+    cropped = crop(xlower, ylower, dx, Z, bounds)
+    if cropped is not None:
+        xlower, ylower, Z = cropped
+    write_tt3(base + '.tt3.tmp', xlower, ylower, dx, nodata, Z)
+    os.rename(base + '.tt3.tmp', base + '.tt3')
+
+    levels = []
+    for level, cellsize in level_cellsizes(model_bounds).items():
+        factor = int(cellsize / dx + 1.e-6)
+        if factor < 2:
+            continue
+        coarse = coarsen(xlower, ylower, dx, nodata, Z, factor)
+        if coarse is None:
+            continue
+        write_tt3(base + '_L%i.tt3.tmp' % level, coarse[0], coarse[1], coarse[2], nodata, coarse[3])
+        os.rename(base + '_L%i.tt3.tmp' % level, base + '_L%i.tt3' % level)
+        levels.append(level)
+    return levels
+
+
+def netcdf_supported():
+    """
+    Whether GeoClaw can be built to read netCDF topography (nf-config of the netCDF Fortran library
+    is on the path) and the tt3 files can be converted (netCDF4 is installed)
+    :return: Boolean
+    """
+    if shutil.which('nf-config') is None:
+        return False
+    try:
+        import netCDF4
+    except ImportError:
+        return False
+    return True
+
+
+def use_netcdf():
+    """
+    Whether to stage netCDF topography: $TOPO_NETCDF if set ('1' or '0'), else whenever it is supported
+    :return: Boolean
+    """
+    setting = os.environ.get('TOPO_NETCDF', '')
+    if setting == '0':
+        return False
+    supported = netcdf_supported()
+    if setting == '1' and not supported:
+        raise RuntimeError("TOPO_NETCDF=1, but netCDF topography needs the netCDF Fortran library (nf-config) to "
+                           "build GeoClaw with NETCDF=True and the python netCDF4 module. Install them, or unset "
+                           "TOPO_NETCDF to run from the ASCII topography files.")
+    if not supported:
+        print("netCDF topography is not supported here (no nf-config or netCDF4), using the tt3 files")
+    return supported
+
+
+def to_netcdf(base):
+    """Writes a netCDF (topo_type 4) copy of base.tt3 if there is none yet"""
+    if not os.path.isfile(base + '.nc'):
+        from clawpack.geoclaw import topotools
+        print("Converting topography", base + '.tt3', "->", base + '.nc')
+        topo = topotools.Topography(base + '.tt3', topo_type=3)
+        topo.write(base + '.nc.tmp', topo_type=4)
+        os.rename(base + '.nc.tmp', base + '.nc')
+
+
+def stage_file(path, cache, manifest, netcdf=False, model_bounds=None):
+    """
+    Places one topography file in the cache. The manifest maps (path, size, mtime) to the fingerprint
+    so files already staged on this node are not read again.
+    :param path: String: topography file (topo_type 3)
+    :param cache: String: cache directory
+    :param manifest: dict: stat key -> fingerprint, updated in place
+    :param netcdf: Boolean: also write netCDF (topo_type 4) copies
+    :param model_bounds: dict: if given, crop to the domain and build the AMR level pyramid
+    :return: String: path of the cached file without extension, list of levels with a pyramid file
+    """
+    stat = os.stat(path)
+    key = '%s:%d:%d' % (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in manifest:
+        manifest[key] = fingerprint(path)
+    base = os.path.join(cache, os.path.splitext(os.path.basename(path))[0] + '_' + manifest[key])
+
+    if model_bounds is None:
+        levels = []
+        if not os.path.isfile(base + '.tt3'):
+            print("Staging topography", path, "->", base + '.tt3')
+            shutil.copyfile(path, base + '.tt3.tmp')
+            os.rename(base + '.tt3.tmp', base + '.tt3')
+    else:
+        grid = [model_bounds[k] for k in ('xlower', 'xupper', 'ylower', 'yupper', 'xcoarse_grid', 'AMR_levels')]
+        base += '_' + hashlib.sha256(json.dumps(grid).encode()).hexdigest()[:8]
+        if base + '.tt3' not in manifest:
+            print("Staging cropped topography and pyramid", path, "->", base + '.tt3')
+            manifest[base + '.tt3'] = make_variants(path, base, model_bounds)
+        levels = manifest[base + '.tt3']
+
+    if netcdf:
+        for variant in [base] + [base + '_L%i' % level for level in levels]:
+            to_netcdf(variant)
+    return base, levels
+
+
+def link(src, dest):
+    """Replaces dest with a symbolic link to src"""
+    if os.path.lexists(dest):
+        os.remove(dest)
+    os.symlink(src, dest)
+
+
+def stage_topo(src_dir, dest_dir, cache=None, netcdf=None, model_bounds=None):
+    """
+    Stages every topography file of a scenario in the node-local cache and links them into the run directory.
+    The per-run dtopo.tt3 is left alone.
+    :param src_dir: String: scenario InputData directory
+    :param dest_dir: String: run InputData directory
+    :param cache: String: cache directory (default: cache_dir())
+    :param netcdf: Boolean: also link netCDF copies, which setrun.py then uses (default: use_netcdf())
+    :param model_bounds: dict: if given, link copies cropped to the domain and the AMR level pyramid
+    :return: list of linked file names
+    """
+    if cache is None:
+        cache = cache_dir()
+    if netcdf is None:
+        netcdf = use_netcdf()
+    os.makedirs(cache, exist_ok=True)
+    os.makedirs(dest_dir, exist_ok=True)
+
+    fnames = sorted(f for f in os.listdir(src_dir) if f.endswith('.tt3') and f != 'dtopo.tt3')
+    manifest_path = os.path.join(cache, 'manifest.json')
+
+    # Chains starting on the same node wait here while one of them stages the files
+    with open(os.path.join(cache, 'manifest.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        manifest = {}
+        if os.path.isfile(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+
+        for fname in fnames:
+            stem = os.path.splitext(fname)[0]
+            base, levels = stage_file(os.path.join(src_dir, fname), cache, manifest, netcdf, model_bounds)
+            variants = [('', fname)] + [('_L%i' % level, stem + '_L%i.tt3' % level) for level in levels]
+            for suffix, name in variants:
+                link(base + suffix + '.tt3', os.path.join(dest_dir, name))
+                if netcdf:
+                    link(base + suffix + '.nc', os.path.join(dest_dir, os.path.splitext(name)[0] + '.nc'))
+
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.rename(manifest_path + '.tmp', manifest_path)
+        fcntl.flock(lock, fcntl.LOCK_UN)
+
+    return fnames
+
+
+def point_topography(points, fnames, input_dir='./InputData/'):
+    """
+    Topography at points, from the nearest cell of the finest of the files covering each point
+    :param points: list of (x, y)
+    :param fnames: list of tt3 file names
+    :param input_dir: String: directory of the files
+    :return: array of elevations (m), nan where no file covers the point
+    """
+    values = np.full(len(points), np.nan)
+    cellsizes = np.full(len(points), np.inf)
+    for fname in fnames:
+        xlower, ylower, dx, nodata, Z = read_tt3(os.path.join(input_dir, fname))
+        nrows, ncols = Z.shape
+        for k, (x, y) in enumerate(points):
+            col, row = int(round((x - xlower) / dx)), int(round((y - ylower) / dx))
+            if 0 <= col < ncols and 0 <= row < nrows and dx < cellsizes[k] and Z[nrows-1-row, col] != nodata:
+                values[k], cellsizes[k] = Z[nrows-1-row, col], dx
+    return values
+
+
+def topo_file(fname, maxlevel=None, input_dir='./InputData/'):
+    """
+    Chooses the topography file GeoClaw should read: the pyramid copy for the finest AMR level of the run
+    if there is one, else the staged file, preferring netCDF copies over tt3 files
+    :param fname: String: tt3 file name
+    :param maxlevel: Int: finest AMR level of the run
+    :param input_dir: String: run InputData directory
+    :return: (topo_type, path)
+    """
+    stem = os.path.join(input_dir, os.path.splitext(fname)[0])
+    candidates = [stem]
+    if maxlevel is not None:
+        candidates.insert(0, stem + '_L%i' % maxlevel)
+    for candidate in candidates:
+        if os.path.isfile(candidate + '.nc'):
+            return 4, candidate + '.nc'
+        if os.path.isfile(candidate + '.tt3'):
+            return 3, candidate + '.tt3'
+    return 3, os.path.join(input_dir, fname)
@@ -0,0 +1,231 @@
+"""
+Fast travel time estimates from the rupture to the refinement regions.
+
+The refinement regions around the gauges force the finest AMR level. There is no need to
+force it before the wave can possibly reach a region, so each region's start time is moved to
+shortly before a lower bound on the arrival time: the great circle distance from the rupture to
+the region divided by the largest shallow water wave speed in the domain.
+
+For the gauges, the eikonal equation |grad T| = 1/sqrt(g h) is solved on the etopo grid with a
+first order fast marching method. By reciprocity the travel time from a rupture to a gauge is the
+travel time from the gauge to the rupture, so one field per gauge, seeded at the gauge, gives the
+arrival times of any rupture by looking the fields up on its subfault rectangles. The fields are
+computed once and cached, after which arrivals for a batch of proposals take milliseconds.
+"""
+import os
+import heapq
+import numpy as np
+from scipy import ndimage
+
+from topo_cache import read_tt3
+from shake import subfault_arrays
+
+GRAVITY = 9.81           # m/s^2
+EARTH_RADIUS = 6367.5e3  # m, same as clawpack.geoclaw.data.Rearth
+
+
+def max_wave_speed(topo_path='./InputData/etopo.tt3'):
+    """
+    Largest shallow water wave speed sqrt(g h) over the topography
+    :param topo_path: String: tt3 file covering the domain
+    :return: float: wave speed in m/s
+    """
+    xlower, ylower, dx, nodata, Z = read_tt3(topo_path)
+    depth = -Z[Z != nodata].min()
+    return np.sqrt(GRAVITY * max(depth, 0.))
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Great circle distance in meters between points given in degrees"""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2)**2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.)))
+
+
+def box_distance(lat, lon, box):
+    """
+    Distance in meters from points to the closest point of a longitude/latitude box
+    :param lat, lon: arrays of point coordinates (degrees)
+    :param box: [x1, x2, y1, y2]
+    :return: array of distances
+    """
+    x1, x2, y1, y2 = box
+    return haversine(lat, lon, np.clip(lat, y1, y2), np.clip(lon, x1, x2))
+
+
+def arrival_lower_bound(okada_params, box, speed):
+    """
+    Lower bound on the time the wave needs to reach a box
+    :param okada_params: pandas Series: okada parameters (see map_to_okada)
+    :param box: [x1, x2, y1, y2]
+    :param speed: float: largest wave speed (m/s)
+    :return: float: time in seconds
+    """
+    sub = subfault_arrays(okada_params)
+    # the sea floor moves up to half a subfault diagonal away from the subfault centers
+    reach = 500. * np.hypot(sub['length'], sub['width'])
+    dist = box_distance(sub['lat'], sub['lon'], box) - reach[:, None]
+    return max(dist.min(), 0.) / speed
+
+
+def region_windows(okada_params, regions_bounds, speed, lead=300.):
+    """
+    Refinement region time windows for a rupture. Each region starts lead seconds before
+    the earliest possible arrival (and never earlier than its start time in model_bounds).
+    :param okada_params: pandas Series: okada parameters (see map_to_okada)
+    :param regions_bounds: list of [t1, t2, x1, x2, y1, y2] from model_bounds
+    :param speed: float: largest wave speed (m/s)
+    :param lead: float: seconds before the earliest arrival to start refining
+    :return: list of [t1, t2, x1, x2, y1, y2]
+    """
+    windows = []
+    for t1, t2, x1, x2, y1, y2 in regions_bounds:
+        arrival = arrival_lower_bound(okada_params, [x1, x2, y1, y2], speed)
+        windows.append([float(max(t1, arrival - lead)), t2, x1, x2, y1, y2])
+    return windows
+
+
+def fast_marching(speed, seeds, dx, dy):
+    """
+    Solves the eikonal equation |grad T| = 1/speed with a first order fast marching method
+    :param speed: (ny, nx) array of wave speeds (m/s), 0 where the wave cannot travel
+    :param seeds: list of (row, col) cells where T = 0
+    :param dx: (ny,) array: east-west grid spacing of each row (m)
+    :param dy: float: north-south grid spacing (m)
+    :return: (ny, nx) array of travel times (s), inf where unreachable
+    """
+    ny, nx = speed.shape
+    # flat python lists are much faster than numpy arrays for this scalar loop
+    c = speed.ravel().tolist()
+    hx = np.repeat(dx, nx).tolist()
+    T = [np.inf] * (ny*nx)
+    known = [False] * (ny*nx)
+
+    heap = []
+    for row, col in seeds:
+        T[row*nx + col] = 0.
+        heap.append((0., row*nx + col))
+    heapq.heapify(heap)
+
+    while heap:
+        t, k = heapq.heappop(heap)
+        if known[k]:
+            continue
+        known[k] = True
+        row, col = divmod(k, nx)
+        for n, ok in ((k - 1, col > 0), (k + 1, col < nx - 1), (k - nx, row > 0), (k + nx, row < ny - 1)):
+            if not ok or known[n] or c[n] <= 0.:
+                continue
+            nrow, ncol = divmod(n, nx)
+            a = min(T[n-1] if ncol > 0 else np.inf, T[n+1] if ncol < nx - 1 else np.inf)
+            b = min(T[n-nx] if nrow > 0 else np.inf, T[n+nx] if nrow < ny - 1 else np.inf)
+            ha, f = hx[n], 1. / c[n]
+
+            # upwind update: one sided if only one direction is available or the two sided solution is not upwind
+            t_new = min(a + ha*f, b + dy*f)
+            if a < np.inf and b < np.inf:
+                wa, wb = 1. / ha**2, 1. / dy**2
+                disc = (wa + wb)*f**2 - wa*wb*(a - b)**2
+                if disc >= 0.:
+                    t_two = (wa*a + wb*b + np.sqrt(disc)) / (wa + wb)
+                    if t_two >= max(a, b):
+                        t_new = min(t_new, t_two)
+            if t_new < T[n]:
+                T[n] = t_new
+                heapq.heappush(heap, (t_new, n))
+
+    return np.array(T).reshape(ny, nx)
+
+
+def grid_index(lat, lon, xlower, ylower, dlon, shape):
+    """
+    Nearest grid cell of points (rows numbered from the north as in tt3 files)
+    :return: row, col arrays and a mask of the points inside the grid
+    """
+    ny, nx = shape
+    col = np.rint((np.asarray(lon) - xlower) / dlon).astype(int)
+    row = ny - 1 - np.rint((np.asarray(lat) - ylower) / dlon).astype(int)
+    inside = (row >= 0) & (row < ny) & (col >= 0) & (col < nx)
+    return np.clip(row, 0, ny - 1), np.clip(col, 0, nx - 1), inside
+
+
+def travel_time_fields(gauges, topo_path='./InputData/etopo.tt3', cache_file='./InputData/travel_times.npz'):
+    """
+    Travel time fields from each gauge over the etopo grid, loaded from cache_file when it was computed
+    for the same gauges and topography
+    :param gauges: list of gauge objects
+    :return: dict with T ((G, ny, nx) array of travel times in seconds) and the grid xlower, ylower, dlon
+    """
+    site = np.array([[gauge.longitude, gauge.latitude] for gauge in gauges], dtype=float)
+    topo_mtime = os.stat(topo_path).st_mtime
+    if os.path.isfile(cache_file):
+        cached = dict(np.load(cache_file))
+        if cached['site'].shape == site.shape and np.allclose(cached['site'], site) and cached['topo_mtime'] == topo_mtime:
+            return cached
+
+    xlower, ylower, dlon, nodata, Z = read_tt3(topo_path)
+    depth = np.where(Z == nodata, 0., -Z)
+    speed = np.sqrt(GRAVITY * np.maximum(depth, 0.))
+
+    lat = ylower + dlon * np.arange(Z.shape[0])[::-1]
+    dy = EARTH_RADIUS * np.radians(dlon)
+    dx = dy * np.cos(np.radians(lat))
+
+    # seeds must lie in the open ocean, not in lakes or isolated wet cells
+    components, count = ndimage.label(speed > 0)
+    ocean = np.argmax(np.bincount(components.ravel())[1:]) + 1
+    wet_rows, wet_cols = np.nonzero(components == ocean)
+    wet_lat, wet_lon = lat[wet_rows], xlower + dlon * wet_cols
+
+    T = np.empty((len(gauges),) + Z.shape)
+    for i, (lon, lat_i) in enumerate(site):
+        # gauges on land in the etopo grid are moved to the closest ocean cell
+        row, col, inside = grid_index(lat_i, lon, xlower, ylower, dlon, Z.shape)
+        if not (inside and components[row, col] == ocean):
+            closest = np.argmin(haversine(lat_i, lon, wet_lat, wet_lon))
+            row, col = wet_rows[closest], wet_cols[closest]
+        print("Computing travel times from gauge", i, "(", lon, ",", lat_i, ")")
+        T[i] = fast_marching(speed, [(int(row), int(col))], dx, dy)
+
+    fields = {'T': T, 'xlower': xlower, 'ylower': ylower, 'dlon': dlon, 'site': site, 'topo_mtime': topo_mtime}
+    np.savez(cache_file, **fields)
+    return fields
+
+
+def rupture_points(okada_params, n=3, midpoints=False):
+    """
+    n x n points on the surface projection of each subfault rectangle
+    :param okada_params: pandas Series (one sample) or DataFrame (one sample per row) of okada parameters
+    :param midpoints: Boolean: use the midpoints of an n x n partition of each rectangle instead of a grid including the edges
+    :return: lat, lon (N, K*n*n) arrays
+    """
+    sub = subfault_arrays(okada_params)
+    strike, dip = np.radians(sub['strike']), np.radians(sub['dip'])
+    if midpoints:
+        u = ((np.arange(n) + .5) / n - .5)[:, None]
+    else:
+        u = np.linspace(-.5, .5, n)[:, None]
+    # offsets along strike and horizontally down dip, (N, K, n, n) in meters
+    along = 1000. * sub['length'][:, None, None, None] * u[None, None, :, :]
+    across = 1000. * (sub['width'][:, None] * np.cos(dip))[:, :, None, None] * u.T[None, None, :, :]
+    north = along * np.cos(strike)[..., None, None] - across * np.sin(strike)[..., None, None]
+    east = along * np.sin(strike)[..., None, None] + across * np.cos(strike)[..., None, None]
+
+    lat = sub['lat'][..., None, None] + np.degrees(north / EARTH_RADIUS)
+    lon = sub['lon'][..., None, None] + np.degrees(east / (EARTH_RADIUS * np.cos(np.radians(lat))))
+    N = lat.shape[0]
+    return lat.reshape(N, -1), lon.reshape(N, -1)
+
+
+def eikonal_arrivals(fields, okada_params):
+    """
+    Arrival times at each gauge: the smallest travel time from any point of the rupture
+    :param fields: dict from travel_time_fields
+    :param okada_params: pandas Series (one sample) or DataFrame (one sample per row) of okada parameters
+    :return: (N, G) array of arrival times in minutes (inf if the wave cannot reach the gauge)
+    """
+    lat, lon = rupture_points(okada_params)
+    T = fields['T']
+    row, col, inside = grid_index(lat, lon, fields['xlower'], fields['ylower'], fields['dlon'], T.shape[1:])
+    times = np.where(inside[:, None, :], T[:, row, col].transpose(1, 0, 2), np.inf)
+    return times.min(axis=-1) / 60.
@@ -4,6 +4,8 @@
 import argparse
 import os
 import sys
+import shutil
+import json
 from datetime import datetime
 
 
@@ -18,13 +20,53 @@ parser = argparse.ArgumentParser(description='Run a tsunamibayes scenario.')
 parser.add_argument('--scen', dest='scenario', default='1852mag',
                    help='scenario to run (default: 1852mag)')
 parser.add_argument('--mcmc', dest='mcmc', default='random_walk',
-                   help='mcmc method to use (default: random_walk)')
+                   help='mcmc method to use, smc for sequential monte carlo, ensemble for the affine invariant ensemble sampler (default: random_walk)')
 #parser.add_argument('--nburn', dest='nburn', default=0,
 #                   help='number of burn in samples (default: 0)')
 parser.add_argument('--adjoint', dest='adjoint', action='store_true',
                     help='run adjoint solve or not (default: False)')
+parser.add_argument('--shake', dest='shake', action='store_true',
+                    help='include the shake (MMI) likelihood (default: False)')
+parser.add_argument('--coarselevel', dest='coarselevel', type=int, default=None,
+                    help='AMR level of the coarse screening run for two stage (delayed acceptance) mcmc (default: None)')
+parser.add_argument('--greens', dest='greens', action='store_true',
+                    help='screen proposals with the linear Green\'s function database before running geoclaw (default: False)')
+parser.add_argument('--regiontimes', dest='regiontimes', action='store_true',
+                    help='start refinement regions shortly before the earliest possible wave arrival (default: False)')
+parser.add_argument('--timeout', dest='timeout', type=float, default=None,
+                    help='stop geoclaw runs taking longer than this multiple of their predicted runtime and reject the proposal (default: None)')
+parser.add_argument('--settle', dest='settle', type=float, default=None,
+                    help='stop geoclaw once the maxima at all fgmax points have been stable for this many simulated seconds (default: None)')
+parser.add_argument('--unitsources', dest='unitsources', action='store_true',
+                    help='build the dtopo files from the unit source library instead of okada, an approximation (default: False)')
+parser.add_argument('--earlyreject', dest='earlyreject', action='store_true',
+                    help='skip geoclaw for proposals that cannot be accepted even with the largest possible likelihood (default: False)')
+parser.add_argument('--particles', dest='particles', type=int, default=100,
+                    help='number of particles for --mcmc smc or walkers for --mcmc ensemble (default: 100)')
+parser.add_argument('--workers', dest='workers', type=int, default=1,
+                    help='number of parallel geoclaw runs for --mcmc smc and ensemble (default: 1)')
+parser.add_argument('--dearchive', dest='dearchive', default=None,
+                    help='archive file shared by chains running at the same time, for differential evolution proposals (default: None)')
+parser.add_argument('--drstages', dest='drstages', type=int, default=None,
+                    help='delayed rejection with adaptive covariance for the custom proposals, with at most this many proposals per iteration (default: None)')
+parser.add_argument('--faultcoords', dest='faultcoords', action='store_true',
+                    help='propose epicenter moves along strike and down dip instead of in latitude/longitude (default: False)')
+parser.add_argument('--gradient', dest='gradient', default=None, choices=['mala', 'hmc'],
+                    help="langevin (mala) or hamiltonian (hmc) proposals using the gradient of the green's function surrogate posterior (default: None)")
+parser.add_argument('--gradstep', dest='gradstep', type=float, default=None,
+                    help='step size of the --gradient proposals relative to the random walk steps (default: 1)')
+parser.add_argument('--output', dest='output', default='mcmc', choices=['mcmc', 'debug'],
+                    help='geoclaw output profile: mcmc (fgmax only) or debug (frames and time step reports) (default: mcmc)')
 parser.add_argument('--nsamp', dest='nsamp', default=1,
-                   help='number of samples (default: 1)')
+                   help='number of samples, the iteration cap with --targetess or --maxhours (default: 1)')
+parser.add_argument('--targetess', dest='targetess', type=float, default=None,
+                    help='stop once every parameter has this effective sample size and a split R-hat below --maxrhat (default: None)')
+parser.add_argument('--maxrhat', dest='maxrhat', type=float, default=1.01,
+                    help='largest split R-hat for the --targetess stopping rule (default: 1.01)')
+parser.add_argument('--maxhours', dest='maxhours', type=float, default=None,
+                    help='stop after this wall time in hours (default: None)')
+parser.add_argument('--chains', dest='chains', default=None,
+                    help="glob pattern of the samples.csv files of the other chains for the ESS and R-hat, e.g. '../*/ModelOutput/1852mag_samples.csv' (default: None)")
 parser.add_argument('--rwcov', dest='rwcov', default=0.5,
                    help='random walk covariance (default: 0.5)')
 parser.add_argument('--init', dest='init', default='random',
@@ -71,11 +113,36 @@ if args.init == 'restart':
 
 os.system("cp Makefile "+args.rundir+"/")         #copy makefile
 os.system("cp -r Classes "+args.rundir+"/")       #copy classes
-os.system("cp -r "+scenDir+"/* "+args.rundir+"/") #copy scenario
+#copy scenario, except for the topography which is staged in a node-local cache and linked
+#and the (large, read only) unit source and Green's function databases which are linked
+for root, dirs, files in os.walk(scenDir):
+    dest = os.path.join(args.rundir, os.path.relpath(root, scenDir))
+    os.makedirs(dest, exist_ok=True)
+    for fname in files:
+        if not fname.endswith('.tt3') and fname not in ['unit_sources.npy', 'greens.npy']:
+            shutil.copy2(os.path.join(root, fname), dest)
+for fname in ['unit_sources.npy', 'greens.npy']:
+    if os.path.isfile(scenDir+'/InputData/'+fname):
+        os.symlink(os.path.abspath(scenDir+'/InputData/'+fname), args.rundir+'/InputData/'+fname)
 os.system("mkdir -p "+args.rundir+"/ModelOutput") #make output directory
 
+sys.path.append('./Classes')
+from topo_cache import stage_topo, use_netcdf
+with open(scenDir+'/PreRun/InputData/model_bounds.txt') as json_file:
+    model_bounds = json.load(json_file)
+#netCDF topography where geoclaw can be built to read it (TOPO_NETCDF=1 to require it, 0 to turn it off)
+netcdf = use_netcdf()
+stage_topo(scenDir+'/InputData', args.rundir+'/InputData', netcdf=netcdf, model_bounds=model_bounds)
+#the geoclaw build (make, see Makefile) picks this up from the environment
+os.environ['NETCDF'] = 'True' if netcdf else 'False'
+if os.path.isfile(scenDir+'/InputData/dtopo.tt3'):
+    os.system("cp "+scenDir+"/InputData/dtopo.tt3 "+args.rundir+"/InputData/")
+
 os.chdir(args.rundir)
 
+#setrun.py picks the geoclaw output profile from the environment
+os.environ['OUTPUT_PROFILE'] = args.output
+
 
 ## RUN THE SCENARIO ##
 
@@ -87,7 +154,7 @@ from Scenario import Scenario
 
 #run the scenario (this needs to be finished)
 ##old version: scenario = Scenario(inputs['title'], inputs['custom'], inputs['init'], inputs['rw_covariance'], inputs['method'], inputs['iterations'])
-scenario = Scenario(title=args.scenario, init=args.init, rw_covariance=args.rwcov, adjoint=args.adjoint, method=args.mcmc, iterations=int(args.nsamp))
+scenario = Scenario(title=args.scenario, init=args.init, rw_covariance=args.rwcov, adjoint=args.adjoint, method=args.mcmc, iterations=int(args.nsamp), shake=args.shake, coarse_level=args.coarselevel, region_times=args.regiontimes, greens=args.greens, timeout_factor=args.timeout, settle_window=args.settle, early_reject=args.earlyreject, particles=args.particles, workers=args.workers, de_archive=args.dearchive, dr_stages=args.drstages, fault_coords=args.faultcoords, gradient=args.gradient, gradient_step=args.gradstep, target_ess=args.targetess, max_rhat=args.maxrhat, max_hours=args.maxhours, chain_files=args.chains, unit_sources=args.unitsources)
 scenario.run()
 
 print("Scenario run complete. Results are in the run directory: "+args.rundir)
@@ -10,7 +10,7 @@ from scipy import stats
 
 from MCMC import MCMC
 from Prior import Prior,LatLonPrior
-from Fault import Fault, GridFault
+from Fault import Fault, GridFault, StrikeCoordinates
 
 from scipy.stats import truncnorm
 
@@ -39,6 +39,8 @@ class Custom(MCMC):
         self.okada_cols = cols
         self.fault = self.build_fault()
         self.prior = self.build_priors()
+        # fault-local proposal coordinates, see use_fault_coordinates
+        self.strike_coords = None
 
     def build_fault(self):
         data = np.load("./InputData/bandadata.npz")
@@ -342,20 +344,12 @@ class Custom(MCMC):
         #print("proposal kernel asymmetry q(sample|proposal)-q(proposalsample):")
         #print(logqs-logqp)
         # Note we use np.exp(new - old) because it's the log-likelihood
-        return min(1, np.exp(change_llh+change_prior_lpdf))
+        return min(1, np.exp(change_llh+change_prior_lpdf+self.samples.proposal_log_ratio))
 
-    def draw(self, prev_draw):
+    def proposal_covariance(self):
         """
-        Draw with the random walk sampling method, using a multivariate_normal
-        distribution with the following specified std deviations to
-        get the distribution of the step size.
-
-        Returns:
-            draws (array): An array of the 9 parameter draws.
+        Covariance of the random walk steps of draw, in the order of sample_cols
         """
-        # deep copy of prev_draw
-        new_draw = prev_draw.copy()
-
         # Random walk draw lat/lon/strike
         longitude_std = 0.075
         latitude_std = 0.075
@@ -371,14 +365,91 @@ class Custom(MCMC):
                                  deltalogl_std,
                                  deltalogw_std,
                                  deltadepth_std]))
+        return cov
+
+    def draw(self, prev_draw):
+        """
+        Draw with the random walk sampling method, using a multivariate_normal
+        distribution with the following specified std deviations to
+        get the distribution of the step size.
+
+        Returns:
+            draws (array): An array of the 9 parameter draws.
+        """
+        # deep copy of prev_draw
+        new_draw = prev_draw.copy()
+
+        cov = self.proposal_covariance()
         mean = np.zeros(6)
 
         # random draw from normal distribution
         e = stats.multivariate_normal(mean, cov).rvs()
         new_draw[['Longitude','Latitude','Magnitude','DeltaLogL','DeltaLogW','DeltaDepth']] += e
 
+        # move the epicenter along strike and down dip instead
+        if self.strike_coords is not None and np.random.random() >= self.latlon_prob:
+            along, across = self.strike_coords.from_lat_lon(prev_draw['Latitude'], prev_draw['Longitude'])
+            if not np.isnan(along):
+                along += self.along_std * np.random.randn()
+                across += self.across_std * np.random.randn()
+                if self.strike_coords.valid(along, across):
+                    new_draw['Latitude'], new_draw['Longitude'] = self.strike_coords.to_lat_lon(along, across)
+                else:
+                    # outside of the one-to-one part of the coordinates, rejected by the prior
+                    new_draw[['Latitude', 'Longitude']] = np.nan
+
         return new_draw
 
+    def use_fault_coordinates(self, along_std=15000., across_std=5000., latlon_prob=0.1, lat=None, lon=None):
+        """
+        Makes draw move the epicenter in fault-local coordinates (StrikeCoordinates): normal steps of the arc
+        length along a strike line of the fault and of the distance across it, so the proposals follow the
+        curve of the fault instead of stepping off it. With probability latlon_prob (and where the fault-local
+        coordinates are not defined) the usual latitude/longitude step is used. The proposal is not symmetric
+        in latitude/longitude, see log_proposal_ratio.
+        :param along_std: float: step along strike (m)
+        :param across_std: float: step across strike, positive dipward (m)
+        :param latlon_prob: float: probability of a latitude/longitude step
+        :param lat: float: latitude of the origin of the strike line
+        :param lon: float: longitude of the origin of the strike line
+            (default: the middle of the fault's depth contour at the mean of the depth prior, see GridFault.contour_point)
+        """
+        if lat is None or lon is None:
+            lat, lon = self.fault.contour_point(self.prior.priors["latlon"].mu)
+        self.strike_coords = StrikeCoordinates(self.fault, lat, lon)
+        self.along_std = along_std
+        self.across_std = across_std
+        self.latlon_prob = latlon_prob
+
+    def log_proposal_ratio(self, sample_params, proposal_params):
+        """
+        log q(sample | proposal) - log q(proposal | sample) of draw. With the fault-local coordinates, the
+        proposal density of the epicenter is the mixture of the latitude/longitude step and of the fault-local
+        step, whose density in latitude/longitude is the normal density of the step divided by the Jacobian
+        determinant of the map to latitude/longitude. The steps of the other parameters cancel.
+        :param sample_params: pandas Series: current sample parameters
+        :param proposal_params: pandas Series: proposal parameters
+        :return: float
+        """
+        if self.strike_coords is None or np.isnan(proposal_params['Latitude']):
+            return 0.
+        x = self.strike_coords.from_lat_lon(sample_params['Latitude'], sample_params['Longitude'])
+        y = self.strike_coords.from_lat_lon(proposal_params['Latitude'], proposal_params['Longitude'])
+
+        # latitude/longitude step, symmetric
+        std = np.sqrt(np.diag(self.proposal_covariance())[:2])
+        delta = (proposal_params[['Longitude', 'Latitude']].to_numpy(dtype=float) - sample_params[['Longitude', 'Latitude']].to_numpy(dtype=float)) / std
+        log_q_latlon = stats.norm.logpdf(delta).sum() - np.log(std).sum()
+        log_forward = log_q_latlon + np.log(self.latlon_prob if not np.isnan(x[0]) else 1.)
+        log_backward = log_q_latlon + np.log(self.latlon_prob if not np.isnan(y[0]) else 1.)
+
+        # fault-local step
+        if not np.isnan(x[0]) and not np.isnan(y[0]) and self.latlon_prob < 1:
+            log_q_fault = stats.norm.logpdf(y[0] - x[0], scale=self.along_std) + stats.norm.logpdf(y[1] - x[1], scale=self.across_std) + np.log(1 - self.latlon_prob)
+            log_forward = np.logaddexp(log_forward, log_q_fault - self.strike_coords.log_jacobian(*y))
+            log_backward = np.logaddexp(log_backward, log_q_fault - self.strike_coords.log_jacobian(*x))
+        return log_backward - log_forward
+
     def build_priors(self):
         """
         Builds the priors
@@ -537,6 +608,30 @@ class Custom(MCMC):
         else:
             return False
 
+    def prior_grad(self, sample, h=1.e-4):
+        """
+        Gradient of prior_logpdf inside its support (the rupture geometry constraints are ignored). The
+        latitude/longitude terms come from the slope of the depth map, piecewise linear in each grid cell.
+        :param sample: pandas Series: sample parameters
+        :param h: float: latitude/longitude difference for the slope of the depth map (degrees)
+        :return: (6,) array in the order of sample_cols
+        """
+        latlon = self.prior.priors["latlon"]
+        lat, lon, deltadepth = sample['Latitude'], sample['Longitude'], sample['DeltaDepth']
+        depth = self.fault.depth_from_lat_lon(lat, lon)[0] + 1000*deltadepth
+        ddepth = -(depth - latlon.mu)/latlon.sigma**2
+        dlat = (self.fault.depth_from_lat_lon(lat + h, lon)[0] - self.fault.depth_from_lat_lon(lat - h, lon)[0])/(2*h)
+        dlon = (self.fault.depth_from_lat_lon(lat, lon + h)[0] - self.fault.depth_from_lat_lon(lat, lon - h)[0])/(2*h)
+
+        grad = pd.Series(0., self.sample_cols)
+        grad['Longitude'] = ddepth*dlon
+        grad['Latitude'] = ddepth*dlat
+        grad['Magnitude'] = -1/self.prior.priors["mag"].kwds.get('scale', 1.)
+        grad['DeltaLogL'] = -sample['DeltaLogL']/self.prior.priors["deltalogl"].std()**2
+        grad['DeltaLogW'] = -sample['DeltaLogW']/self.prior.priors["deltalogw"].std()**2
+        grad['DeltaDepth'] = 1000*ddepth - deltadepth/self.prior.priors["deltadepth"].std()**2
+        return np.nan_to_num(grad.to_numpy(dtype=float))
+
     def prior_logpdf(self,sample):
         length = self.get_length(sample['DeltaLogL'],sample['Magnitude'])
         width = self.get_width(sample['DeltaLogW'],sample['Magnitude'])
@@ -72,6 +72,32 @@ class GridFault(Fault):
     def dip_from_lat_lon(self,lat,lon):
         return self.dip_map([lat,lon])[0]
 
+    def contour_point(self,depth,tol=1000.):
+        """Grid point of a depth contour of the fault: of the grid points
+        whose depth is within tol of depth (and whose strike is defined), the
+        one nearest to their centroid.
+
+        Parameters
+        ----------
+        depth : float
+            Depth of the contour, in meters
+        tol : float
+            Largest depth difference of the contour points, in meters
+
+        Returns
+        -------
+        lat,lon : float
+        """
+        lats,lons = np.meshgrid(self.lat,self.lon,indexing='ij')
+        lats,lons = lats.ravel(),lons.ravel()
+        strikes = self.strike_map(np.vstack((lats,lons)).T)
+        near = np.isfinite(strikes) & (np.abs(self.depth.ravel()-depth) < tol)
+        if not np.any(near):
+            raise ValueError("The fault has no point at a depth of {:.0f} m".format(depth))
+        lats,lons = lats[near],lons[near]
+        i = np.argmin((lats-lats.mean())**2 + (lons-lons.mean())**2)
+        return lats[i],lons[i]
+
 
 class ReferenceCurveFault(Fault):
     """A class for data relating to the fault"""
@@ -215,3 +241,99 @@ class ReferenceCurveFault(Fault):
             side = -np.sign(distance)
             distance = np.abs(distance)
         return self.depth_curve(side*distance),self.dip_curve(side*distance)
+
+
+class StrikeCoordinates:
+    """Fault-local coordinates of a GridFault: the arc length along a strike
+    line traced through the fault, and the horizontal distance from it
+    perpendicular to the strike, positive dipward. Both are in meters.
+
+    The map to lat/lon is not one-to-one far from the strike line on the
+    concave side of the fault, so the coordinates of a point are those of the
+    nearest point of the strike line (refined by Newton iterations), and only
+    coordinates that map back to themselves are valid (see valid).
+    """
+    def __init__(self,fault,lat,lon,spacing=1000.,max_steps=5000):
+        """
+        Parameters
+        ----------
+        fault : instance of GridFault
+            Fault providing the strike field
+        lat,lon : float
+            Point of the strike line, where the arc length is zero
+        spacing : float
+            Step of the strike line, in meters
+        max_steps : int
+            Largest number of steps in each direction
+        """
+        self.fault = fault
+        self.R = fault.R
+        lats,lons,strikes = [lat],[lon],[fault.strike_from_lat_lon(lat,lon)]
+        if np.isnan(strikes[0]):
+            raise ValueError("The origin of the strike line must be on the fault")
+        # trace the strike line strikeward and anti-strikeward until it leaves the fault
+        for sgn in [1,-1]:
+            trace = []
+            la,lo,strike = lat,lon,strikes[0]
+            for i in range(max_steps):
+                la,lo = Fault.step(la,lo,strike if sgn > 0 else strike-180,spacing,self.R)
+                strike = fault.strike_from_lat_lon(la,lo)
+                if np.isnan(strike): break
+                trace.append((la,lo,strike))
+            if sgn > 0:
+                forward = trace
+            else:
+                backward = trace[::-1]
+        trace = np.array(backward + [(lat,lon,strikes[0])] + forward)
+        self.lats,self.lons = trace[:,0],trace[:,1]
+        self.arc = spacing*(np.arange(len(trace)) - len(backward))
+        # interpolate the strike through its unit vector to avoid the wrap at 360
+        self.east,self.north = np.sin(np.deg2rad(trace[:,2])),np.cos(np.deg2rad(trace[:,2]))
+
+    def to_lat_lon(self,along,across):
+        """Lat/lon coordinates of fault-local coordinates (nan off the strike line)"""
+        if not self.arc[0] <= along <= self.arc[-1]:
+            return np.nan,np.nan
+        lat = np.interp(along,self.arc,self.lats)
+        lon = np.interp(along,self.arc,self.lons)
+        strike = np.degrees(np.arctan2(np.interp(along,self.arc,self.east),np.interp(along,self.arc,self.north)))
+        return Fault.step(lat,lon,strike+90,across,self.R)
+
+    def jacobian(self,along,across,h=10.):
+        """Jacobian matrix d(lat,lon)/d(along,across), by central differences"""
+        J = np.empty((2,2))
+        J[:,0] = np.subtract(self.to_lat_lon(along+h,across),self.to_lat_lon(along-h,across))/(2*h)
+        J[:,1] = np.subtract(self.to_lat_lon(along,across+h),self.to_lat_lon(along,across-h))/(2*h)
+        return J
+
+    def log_jacobian(self,along,across):
+        """Log of the absolute Jacobian determinant of the map to lat/lon"""
+        return np.log(np.abs(np.linalg.det(self.jacobian(along,across))))
+
+    def from_lat_lon(self,lat,lon,tol=1.e-3,maxiter=20):
+        """Fault-local coordinates of a lat/lon point: starts at the nearest
+        point of the strike line and solves to_lat_lon(along,across) = (lat,lon)
+        by Newton iterations. Returns nans if they do not converge.
+        """
+        if np.isnan(lat) or np.isnan(lon):
+            return np.nan,np.nan
+        distances = Fault.haversine(self.R,lat,lon,self.lats,self.lons)
+        idx = distances.argmin()
+        along = self.arc[idx]
+        strike = np.degrees(np.arctan2(self.east[idx],self.north[idx]))
+        across = distances[idx]*np.sin(np.deg2rad(Fault.bearing(self.lats[idx],self.lons[idx],lat,lon)-strike))
+        for i in range(maxiter):
+            point = self.to_lat_lon(along,across)
+            if np.isnan(point[0]):
+                return np.nan,np.nan
+            step = np.linalg.solve(self.jacobian(along,across),np.subtract((lat,lon),point))
+            along,across = along+step[0],across+step[1]
+            if np.abs(step).max() < tol:
+                return along,across
+        return np.nan,np.nan
+
+    def valid(self,along,across,tol=1.):
+        """Whether fault-local coordinates are the coordinates of their lat/lon point"""
+        lat,lon = self.to_lat_lon(along,across)
+        back = self.from_lat_lon(lat,lon)
+        return not np.isnan(back[0]) and np.hypot(back[0]-along,back[1]-across) < tol
@@ -43,19 +43,23 @@ def get_topo(makeplots=False):
         print("Created ",fname)
 
 
-def makeqinit():
+def makeqinit(scale=150, support=5., outfile="hump.xyz"):
     """
         Create qinit data file
+
+        The hump is a sum of Gaussians exp(-(r/scale)**2), r in meters, centered
+        on the fgmax points. The grid is regular, so the cells within support*scale
+        of each point are found directly from the grid spacing and each Gaussian is
+        only added there (it is below exp(-support**2) elsewhere). The cost scales
+        with the number of points instead of points x grid size.
+
+        GeoClaw reads qinit files as formatted x,y,z lines only, so the result is
+        still written in topotype 1 layout, in a single savetxt call.
     """
+    from clawpack.geoclaw.util import haversine
+    from clawpack.geoclaw.data import Rearth
 
-    with open("../../PreRun/InputData/fgmax_grid.txt") as f:
-        temp = f.readlines()
-    temp = temp[7:]
-    data = zeros((len(temp),2))
-    for i in range(len(temp)):
-        lon, lat = temp[i].split()
-        data[i][0] = lon
-        data[i][1] = lat
+    data = loadtxt("../../PreRun/InputData/fgmax_grid.txt", skiprows=7, ndmin=2)
     xcenter = data[:,0]
     ycenter = data[:,1]
 
@@ -71,23 +75,35 @@ def makeqinit():
     print(nxpoints)
     print(nypoints)
 
-    def qinit(x,y,scale=150):
-        from numpy import where
-        from clawpack.geoclaw.util import haversine
-
-        z = 0
-
-    # Gaussian using distance in meters:
-        for i in range(len(xcenter)):
-            r = haversine(x,y,xcenter[i],ycenter[i])
-        #    z = exp(-(r/20e3)**2)
-            z = z+exp(-(r/scale)**2)  #This is highly debatable...does this decay to quickly to register on the rough grid we are using?  If we have the decay slower, are we going to have the problem of multiple points stacking up and biasing the solver?
-        return z
+    x = linspace(xlower,xupper,nxpoints)
+    y = linspace(ylower,yupper,nypoints)
+    dx = x[1]-x[0]
+    dy = y[1]-y[0]
 
+    # half widths (in cells) of the window holding each Gaussian's support
+    radius = support*scale
+    dlat = degrees(radius/Rearth)
+    dlon = dlat/cos(radians(max(abs(ycenter))+dlat))
+    offx = arange(-int(ceil(dlon/dx)), int(ceil(dlon/dx))+1)
+    offy = arange(-int(ceil(dlat/dy)), int(ceil(dlat/dy))+1)
 
+    # grid indices of every (point, window cell) pair
+    ix = rint((xcenter-xlower)/dx).astype(int)[:,None,None] + offx[None,None,:]
+    iy = rint((ycenter-ylower)/dy).astype(int)[:,None,None] + offy[None,:,None]
+    ix, iy = broadcast_arrays(ix, iy)
+    inside = (ix >= 0) & (ix < nxpoints) & (iy >= 0) & (iy < nypoints)
 
-    outfile= "hump.xyz"
-    topotools.topo1writer(outfile,qinit,xlower,xupper,ylower,yupper,nxpoints,nypoints)
+    # Gaussian using distance in meters:
+    r = haversine(x[clip(ix,0,nxpoints-1)], y[clip(iy,0,nypoints-1)],
+                  xcenter[:,None,None], ycenter[:,None,None])
+    keep = inside & (r <= radius)
+    #This is highly debatable...does this decay to quickly to register on the rough grid we are using?  If we have the decay slower, are we going to have the problem of multiple points stacking up and biasing the solver?
+    z = zeros((nypoints,nxpoints))
+    add.at(z, (iy[keep], ix[keep]), exp(-(r[keep]/scale)**2))
+
+    # topotype 1: rows from the upper left corner across, then down
+    X,Y = meshgrid(x, y[::-1])
+    savetxt(outfile, column_stack((X.ravel(), Y.ravel(), z[::-1].ravel())), fmt='%22.15e')
 
 if __name__=='__main__':
     get_topo(False)
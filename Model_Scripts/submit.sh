@@ -20,6 +20,15 @@ module purge; module load Anaconda/5.2.0 parallel
 #define the TMPFS environment variable if it isn't already defined (e.g., at BYU)
 [[ -z $TMPFS ]] && export TMPFS=$TMPDIR
 
+#adjoint solutions are cached (and shared by chains on this node) in $TMPFS/adjoint_cache
+#set ADJOINT_CACHE to share them more widely, e.g., across jobs
+#export ADJOINT_CACHE=$workdir/../../adjoint_cache
+
+#topography files are staged once per node in $TMPFS/topo_cache and linked into the run directories
+#they are converted to netCDF where the netCDF Fortran library (nf-config) and the python netCDF4 module are available
+#set TOPO_NETCDF=1 to require the netCDF files, TOPO_NETCDF=0 to always run from the ASCII files
+#export TOPO_NETCDF=0
+
 #e.g., "520404_br"
 jobid="$( echo $SLURM_JOB_ID | sed 's/\..*$//' )_$( hostname | grep -o ^.. )"
 